@@ -19,6 +19,7 @@ from SBO_GUI import Ui_SBO
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 from oodx import DataHandler, GPR, GPC, NN, HybridModel, OODXBlock, Genetic
+from oodx.data import DATASET_EXT, load_array, read_space
 from sklearn.metrics import *
 import mplcursors
 import pyomo.environ as pyo
@@ -167,48 +168,56 @@ class MainWindow(QMainWindow):
     def upload_input(self):
         options = QFileDialog.Options()
         file_path, _ = QFileDialog.getOpenFileName(self, "Select Input File", "",
-                                                   "All Files (*);;Text Files (*.txt);;CSV Files (*.csv)",
+                                                   "All Files (*);;Dataset Files (*.oodx);;Text Files (*.txt);;NumPy Files (*.npy);;CSV Files (*.csv)",
                                                    options=options)
-        if file_path:
+        if file_path.endswith(DATASET_EXT):
+            self.upload_dataset(file_path)
+        elif file_path:
             self.ui.textEdit_Input_Data.setText(os.path.basename(file_path))
-            self.data.x = np.loadtxt(file_path)
+            self.data.x = load_array(file_path)
 
     def upload_space(self):
         options = QFileDialog.Options()
         file_path, _ = QFileDialog.getOpenFileName(self, "Select Space File", "",
                                                    "All Files (*);;Text Files (*.txt);;CSV Files (*.csv)",
                                                    options=options)
-        space = []
-        pattern = re.compile(r'\((.*?)\)')
-        with open(file_path, "r") as file:
-            for line in file:
-                line = line.strip()
-                match = pattern.search(line)
-                if match:
-                    tuple_str = match.group(1)
-                    tuple_vals = tuple(map(float, tuple_str.split(',')))
-                    space.append(tuple_vals)
-        self.data.space = space
         if file_path:
+            self.data.space = read_space(file_path)
             self.ui.textEdit_Space.setText(os.path.basename(file_path))
 
     def upload_output(self):
         options = QFileDialog.Options()
         file_path, _ = QFileDialog.getOpenFileName(self, "Select Output File", "",
-                                                   "All Files (*);;Text Files (*.txt);;CSV Files (*.csv)",
+                                                   "All Files (*);;Dataset Files (*.oodx);;Text Files (*.txt);;NumPy Files (*.npy);;CSV Files (*.csv)",
                                                    options=options)
-        if file_path:
+        if file_path.endswith(DATASET_EXT):
+            self.upload_dataset(file_path)
+        elif file_path:
             self.ui.textEdit_Output_Data.setText(os.path.basename(file_path))
-            self.data.y = np.loadtxt(file_path)
+            self.data.y = load_array(file_path)
 
     def upload_process(self):
         options = QFileDialog.Options()
         file_path, _ = QFileDialog.getOpenFileName(self, "Select Convergence File", "",
-                                                   "All Files (*);;Text Files (*.txt);;CSV Files (*.csv)",
+                                                   "All Files (*);;Dataset Files (*.oodx);;Text Files (*.txt);;NumPy Files (*.npy);;CSV Files (*.csv)",
                                                    options=options)
-        if file_path:
+        if file_path.endswith(DATASET_EXT):
+            self.upload_dataset(file_path)
+        elif file_path:
             self.ui.textEdit_Process.setText(os.path.basename(file_path))
-            self.data.t = np.loadtxt(file_path)
+            self.data.t = load_array(file_path)
+
+    def upload_dataset(self, file_path):
+        # a binary dataset store carries x, y, t and the space in one memory-mapped file
+        self.data.load(file_path)
+        name = os.path.basename(file_path)
+        self.ui.textEdit_Input_Data.setText(name)
+        if self.data.y is not None:
+            self.ui.textEdit_Output_Data.setText(name)
+        if self.data.t is not None:
+            self.ui.textEdit_Process.setText(name)
+        if self.data.space is not None:
+            self.ui.textEdit_Space.setText(name)
 
     def data_preprocess(self):
         if self.data.t is None:
@@ -249,11 +258,17 @@ class MainWindow(QMainWindow):
         QApplication.processEvents()
 
         if self.model == "Gaussian Process(Regression)":
-            gpr = GPR(kernel=self.kernel)
+            # a restart on a few hundred samples costs less than starting the worker processes, so small data sets
+            # are fitted serially
+            n_jobs = -1 if self.data.x_train_.shape[0] >= 500 else 1
+            gpr = GPR(kernel=self.kernel, n_jobs=n_jobs, patience=25)
             gpr.fit(self.data.x_train_, self.data.y_train_[:, 0], iprint=True)
             self.trained_model = gpr
             self.ui.textEdit_Results.append(
                 '{} model fitted! Time elapsed {:.5f} s'.format(self.trained_model.name, self.trained_model.time))
+            self.ui.textEdit_Results.append(
+                '{} hyperparameter restarts, {:.5f} s each on average'.format(
+                    len(self.trained_model.restart_times), np.mean(self.trained_model.restart_times)))
             kernel_params = self.trained_model.kernel_.get_params()
             self.ui.textEdit_Results.append("Kernel Parameters:")
             for param, value in kernel_params.items():
@@ -279,6 +294,8 @@ class MainWindow(QMainWindow):
             epochs = int(self.ui.lineEdit_Epochs.text())
             learning_rate = float(self.ui.lineEdit_Learning_Rate.text())
             decay = float(self.ui.lineEdit_Weight_Decay.text())
+            # about a hundred progress lines, redrawing the text box every epoch costs more than the epoch
+            callback_every = max(1, epochs // 100)
 
             def callback(epoch, loss):
                 self.ui.textEdit_Results.append(f"Epoch {epoch + 1}/{epochs}, Loss: {loss}\n")
@@ -287,15 +304,16 @@ class MainWindow(QMainWindow):
             if self.model == "Neural Network(Regression)":
                 nn = NN(layers, activation=self.activation)
                 nn.fit(self.data.x_train_, self.data.y_train_[:, 0], callback=callback, batch_size=batch_size,
-                       learning_rate=learning_rate, epochs=epochs, weight_decay=decay)
+                       learning_rate=learning_rate, epochs=epochs, weight_decay=decay, callback_every=callback_every)
             else:
                 nn = NN(layers, self.activation, is_classifier=True)
                 nn.fit(self.data.x_train_, self.data.t_train,
                        callback=callback, batch_size=batch_size, learning_rate=learning_rate,
-                       epochs=epochs, weight_decay=decay)
+                       epochs=epochs, weight_decay=decay, callback_every=callback_every)
             self.trained_model = nn
             self.ui.textEdit_Results.append(
-                '{} model fitted! Time elapsed {:.5f} s'.format(self.trained_model.name, self.trained_model.time))
+                '{} model fitted! Time elapsed {:.5f} s, {:.1f} epochs/s'.format(
+                    self.trained_model.name, self.trained_model.time, self.trained_model.epochs_per_second))
 
         elif self.model == "Hybrid(Regression)":
             layers = self.ui.lineEdit_HB_NNnodes.text()
@@ -339,7 +357,7 @@ class MainWindow(QMainWindow):
             omo.inputs = pyo.Var(omo.n_inputs, bounds=self.data.space)
             omo.output = pyo.Var()
             omo.obj = pyo.Objective(expr=omo.output, sense=pyo.maximize)
-            omo.block = OODXBlock(self.trained_model, self.data).get_formulation()
+            omo.block = OODXBlock(self.trained_model, self.data).get_formulation(space=self.data.space)
             omo.c = pyo.ConstraintList()
             omo.c.add(omo.output == omo.block.outputs[0])
             for i in omo.n_inputs:
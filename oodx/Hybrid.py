@@ -5,6 +5,7 @@ import gpytorch as gpy
 import numpy as np
 import time
 from .nn import NN
+from .gp import _chunk_size
 
 
 class HybridModel(gpy.models.ExactGP):
@@ -80,18 +81,28 @@ class HybridModel(gpy.models.ExactGP):
         for name, param in trainable_params.items():
             print(f'Parameter: {name}, Value: {param.data}')
 
-    def predict(self, x, return_std=False):
-        x = torch.from_numpy(x).type(torch.float32)
-        # print(f'Input shape: {x.shape}')  # Debug information
-        self.eval()  # Set the model to evaluation mode
-        with torch.no_grad():
-            # print(f'Transformed input shape: {x_transformed.shape}')  # Debug information
-            y = self(x).mean  # Access mean prediction from the GP model
-            if return_std:
-                y_var = self(x).variance  # Access variance prediction from the GP model
-                return y.numpy(), y_var.numpy()
-            else:
-                return y.numpy()
+    def predict(self, x, return_std=False, chunk_size=None):
+        '''
+        x                     -       inputs (n, n_inputs), float32 arrays are used without a copy
+        return_std            -       also return the posterior variance, skipped otherwise
+        chunk_size            -       points per chunk, by default at most 1024 and sized to keep each cross-kernel
+                                      near 64 MB, gpytorch builds the dense test covariance of a chunk
+        the training-data caches of the posterior are built on the first call and reused until the next fit
+        '''
+        x = torch.from_numpy(np.ascontiguousarray(np.asarray(x, dtype=np.float32)))
+        chunk_size = chunk_size or min(1024, _chunk_size(self.x_train.shape[0]))
+        # eval keeps gpytorch's prediction strategy, only train() clears it
+        self.eval()
+        mean, var = [], []
+        with torch.inference_mode(), gpy.settings.skip_posterior_variances(not return_std):
+            for i in range(0, x.shape[0], chunk_size):
+                posterior = self(x[i:i + chunk_size])
+                mean.append(posterior.mean)
+                if return_std:
+                    var.append(posterior.variance)
+        if return_std:
+            return torch.cat(mean).numpy(), torch.cat(var).numpy()
+        return torch.cat(mean).numpy()
 
     def _kernel(self, kernel):
 
@@ -114,16 +125,18 @@ class HybridModel(gpy.models.ExactGP):
         return kernel
 
     def save_params(self):
-        for layer in self.feature_extractor:
-            if isinstance(layer, nn.Linear):
-                self.weights.append(layer.weight.data.numpy())
-                self.biases.append(layer.bias.data.numpy())
+        # snapshot of the current layers, replaced rather than appended so refitting keeps one entry per layer
+        self.weights = [layer.weight.detach().cpu().numpy().copy() for layer in self.feature_extractor
+                        if isinstance(layer, nn.Linear)]
+        self.biases = [layer.bias.detach().cpu().numpy().copy() for layer in self.feature_extractor
+                       if isinstance(layer, nn.Linear)]
 
         if self.kernel == 'rbf':
             self.length_scale = self.covar_module.base_kernel.lengthscale.item()
         self.output_scale = self.covar_module.outputscale.item()
         self.noise_variance = self.likelihood.noise
-        self.constant_mean = self.mean_module.constant
+        # a float, assigning the Parameter would register it a second time in state_dict
+        self.constant_mean = self.mean_module.constant.item()
 
         self.eval()
         with torch.no_grad():
@@ -1,7 +1,20 @@
 from .data import DataHandler
-from .nn import NN
-from .gp import GPR, GPC
-from .Hybrid import HybridModel
+from .gp import GPR, SparseGPR, GPC
 from .formulations import OODXBlock
 from .genetic import Genetic
 from .adaptive import AdaptiveSampler
+from ._forward import forward
+
+# the torch-backed models are imported on first use, so numpy-only inference through forward never loads torch
+_lazy = {'NN': '.nn', 'HybridModel': '.Hybrid', 'NNSearch': '.search'}
+__all__ = ['DataHandler', 'NN', 'GPR', 'SparseGPR', 'GPC', 'HybridModel', 'OODXBlock', 'Genetic', 'AdaptiveSampler',
+           'NNSearch', 'forward']
+
+
+def __getattr__(name):
+    if name in _lazy:
+        import importlib
+        value = getattr(importlib.import_module(_lazy[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def _activation(name):
+    # vectorised numpy activation matching the torch layer
+    if name == 'tanh':
+        return np.tanh
+    elif name == 'sigmoid':
+        return lambda x: 0.5 * (1 + np.tanh(0.5 * x))
+    elif name == 'softplus':
+        return lambda x: np.logaddexp(0, x)
+    elif name == 'relu':
+        return lambda x: np.maximum(x, 0)
+    elif name == 'linear':
+        return lambda x: x
+    elif name == 'hardsigmoid':
+        return lambda x: np.clip(x / 6 + 0.5, 0, 1)
+    elif name in ('leakyrelu', 'leaky relu'):
+        return lambda x: np.where(x > 0, x, 1e-2 * x)
+    raise ValueError('unknown activation {}'.format(name))
+
+
+def forward(x, weights, biases, activation='tanh', chunk_size=None):
+    '''
+    batched forward pass of a fully connected network in numpy, no torch needed once the weights are exported
+    x                     -       inputs (n, n_inputs)
+    weights               -       list of (n_out, n_in) arrays
+    biases                -       list of (n_out,) arrays
+    activation            -       activation of every hidden layer, the output layer is linear
+    chunk_size            -       rows per batched matrix product, by default 2**16 activations of the widest layer so a
+                                  chunk stays in cache
+    '''
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    af = _activation(activation)
+    # transpose and widen the weights once, not per chunk
+    w = [np.ascontiguousarray(np.asarray(wi, dtype=np.float64).T) for wi in weights]
+    b = [np.asarray(bi, dtype=np.float64) for bi in biases]
+    if chunk_size is None:
+        chunk_size = max(1, 2 ** 16 // max([wi.shape[1] for wi in w] + [x.shape[1]]))
+    output = np.empty((x.shape[0], w[-1].shape[1]))
+    for i in range(0, x.shape[0], chunk_size):
+        a = x[i:i + chunk_size]
+        for l in range(len(w) - 1):
+            a = af(a @ w[l] + b[l])
+        np.add(a @ w[-1], b[-1], out=output[i:i + chunk_size])
+    return output
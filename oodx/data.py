@@ -1,11 +1,143 @@
 import numpy as np
 
-
-from skopt.space import Space
-from skopt.sampler import Lhs, Sobol
 from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import StandardScaler
-import math
+import json
+import re
+import struct
+
+from .sampling import LHS, iter_samples, sample
+
+
+# binary dataset store: magic, little-endian header length, json header, 64-byte aligned raw arrays
+DATASET_EXT = '.oodx'
+_MAGIC = b'OODXDATA'
+_ALIGN = 64
+_MOMENTS = ('x_mean', 'x_std', 'y_mean', 'y_std', 'x_train_mean', 'x_train_std', 'y_train_mean', 'y_train_std')
+
+
+class Scaler:
+    '''
+    broadcast standard scaler, x_ = (x - mean) / std along the last axis, arrays with fewer columns than moments
+    are scaled with the moments of the leading columns
+    mean, std         -       per-feature moments, fitted with fit() if not given
+    dtype             -       working precision of transforms: float32 or float64
+    frozen            -       if True the moments are read-only and cannot be refitted
+    '''
+    def __init__(self, mean=None, std=None, dtype=np.float64, frozen=False):
+        self.dtype = np.dtype(dtype)
+        self.mean = None
+        self.std = None
+        self.frozen = False
+        # running sample count and sum of squared deviations for partial_fit
+        self.n = 0
+        self._m2 = None
+        if mean is not None:
+            self._set_moments(mean, std)
+        if frozen:
+            self.freeze()
+
+    def fit(self, x):
+        self.n = 0
+        return self.partial_fit(x)
+
+    def partial_fit(self, x):
+        # Welford-style merge of the moments of x into the running moments
+        if self.frozen:
+            raise RuntimeError('cannot refit a frozen Scaler')
+        x = np.asarray(x, dtype=np.float64)
+        x = x.reshape(-1, x.shape[-1]) if x.ndim > 1 else x.reshape(-1, 1)
+        k = x.shape[0]
+        if k == 0:
+            return self
+        mean = x.mean(axis=0)
+        m2 = np.square(x - mean).sum(axis=0)
+        if self.n > 0:
+            n = self.n + k
+            delta = mean - self.mean
+            mean = self.mean + delta * k / n
+            m2 = self._m2 + m2 + np.square(delta) * self.n * k / n
+            k = n
+        self.n, self._m2 = k, m2
+        self._set_moments(mean, np.sqrt(m2 / k))
+        return self
+
+    def freeze(self):
+        # moments become read-only so surrogates built on them stay valid
+        self.frozen = True
+        if self.mean is not None:
+            for arr in (self.mean, self.std, self._mean, self._std):
+                arr.flags.writeable = False
+        return self
+
+    def copy(self, dtype=None, frozen=None):
+        return Scaler(
+            self.mean, self.std,
+            dtype=self.dtype if dtype is None else dtype,
+            frozen=self.frozen if frozen is None else frozen)
+
+    def transform(self, x, out=None):
+        x = np.asarray(x)
+        mean, std = self._moments_for(x)
+        if out is None:
+            out = np.empty(x.shape, dtype=self._result_type(x))
+        np.subtract(x, mean, out=out)
+        np.divide(out, std, out=out)
+        return out
+
+    def inverse_transform(self, x, out=None):
+        x = np.asarray(x)
+        mean, std = self._moments_for(x)
+        if out is None:
+            out = np.empty(x.shape, dtype=self._result_type(x))
+        np.multiply(x, std, out=out)
+        np.add(out, mean, out=out)
+        return out
+
+    def transform_space(self, space):
+        bounds = np.asarray(space, dtype=np.float64)
+        return [[lb, ub] for lb, ub in self.transform(bounds.T).T.tolist()]
+
+    def _set_moments(self, mean, std):
+        self.mean = np.array(mean, dtype=np.float64).ravel()
+        self.std = np.array(std, dtype=np.float64).ravel()
+        # constant features are left unscaled, as in sklearn's StandardScaler
+        self.std[self.std < 10 * np.finfo(np.float64).eps] = 1.0
+        self._mean = self.mean.astype(self.dtype)
+        self._std = self.std.astype(self.dtype)
+
+    def _moments_for(self, x):
+        # a model of the first outputs predicts fewer columns than the data holds
+        if x.ndim > 1 and x.shape[-1] < self._mean.shape[0]:
+            return self._mean[:x.shape[-1]], self._std[:x.shape[-1]]
+        return self._mean, self._std
+
+    def _result_type(self, x):
+        if self.dtype == np.float32:
+            return self.dtype
+        return np.result_type(x.dtype, self.dtype)
+
+
+class _RowBuffer:
+    ''' preallocated array grown geometrically along the first axis, exposing the filled rows as view '''
+    def __init__(self, arr):
+        arr = np.asarray(arr)
+        self.data = np.empty((max(2 * arr.shape[0], 16),) + arr.shape[1:], dtype=np.result_type(arr, np.float64))
+        self.data[:arr.shape[0]] = arr
+        self.n = arr.shape[0]
+        self.view = self.data[:self.n]
+
+    def resize(self, n):
+        if n > self.data.shape[0]:
+            data = np.empty((max(2 * self.data.shape[0], n),) + self.data.shape[1:], dtype=self.data.dtype)
+            data[:self.n] = self.data[:self.n]
+            self.data = data
+        self.n = n
+        self.view = self.data[:n]
+
+    def append(self, rows):
+        n = self.n
+        self.resize(n + rows.shape[0])
+        self.data[n:self.n] = rows
 
 
 class DataHandler:
@@ -40,13 +172,21 @@ class DataHandler:
         self.x_train_std = None
         self.y_train_mean = None
         self.y_train_std = None
+        # frozen scalers handed out for the current moments
+        self._scalers = {}
+        # running moments behind the published ones, held fixed on append while frozen
+        self._moments = {}
+        self.frozen = False
+        # growable storage behind the raw and scaled arrays extended by append
+        self._buffers = {}
     
-    def init(self, n_samples, space, n_outputs=1, method='lhs'):
+    def init(self, n_samples, space, n_outputs=1, method='lhs', seed=None):
         '''
         n_samples         -       number of inputs samples
         space             -       input space
         n_outputs         -       number of ouput dimensions to initialise
         method            -       sampling method: random, lhs, sobol, grid
+        seed              -       random seed, seeded lhs designs are reused from the design cache
         '''
 
         # save space and initialise outputs and targets
@@ -54,35 +194,24 @@ class DataHandler:
         self.y = np.zeros((n_samples, n_outputs))
         self.t = np.ones((n_samples, 1))
 
-        if method == 'random':
-            mat = np.random.rand(n_samples, len(self.space))
-            samples = np.zeros_like(mat)
-            for i in range(n_samples):
-                for j in range(len(self.space)):
-                    samples[i][j] = mat[i][j] * (self.space[j][1] - self.space[j][0]) + self.space[j][0]
-            self.x = samples
-
-        elif method == 'lhs':
-            lhs = Lhs(criterion='maximin', iterations=1000)
-            input_space = Space(self.space)
-            lhs_samples = lhs.generate(input_space.dimensions, n_samples)
-            self.x = np.array(lhs_samples)
-
-        elif method == 'sobol':
-            sobol = Sobol()
-            input_space = Space(self.space)
-            sobol_samples = sobol.generate(input_space.dimensions, n_samples)
-            self.x = np.array(sobol_samples)
-        
-        elif method == 'grid':
-            m = len(space)
-            n = math.ceil(n_samples ** (1/m))
-            x1, x2 = np.linspace(*self.space[0], n), np.linspace(*self.space[1], n)
-            x1_grid, x2_grid = np.meshgrid(x1, x2)
-            grid = np.c_[x1_grid.ravel(), x2_grid.ravel()]
-            samples = np.array(grid)
-            np.random.shuffle(samples)
-            self.x = samples[:n_samples]
+        if method == 'lhs':
+            self.x = LHS(criterion='maximin', iterations=1000).generate(self.space, n_samples, seed=seed)
+
+        else:
+            # random, sobol and shuffled n-dimensional grid designs
+            self.x = sample(self.space, n_samples, method=method, seed=seed)
+
+    def iter_samples(self, n_samples=None, method='random', chunk_size=10000, space=None, seed=None, **kwargs):
+        '''
+        n_samples         -       number of samples, for grid None streams the full grid of the given levels
+        method            -       sampling method: random, lhs, sobol, grid
+        chunk_size        -       maximum number of rows per yielded chunk
+        space             -       input space, defaults to the handler's space
+        seed              -       seed or numpy Generator for reproducible designs
+        generator of design chunks for batch prediction and sensitivity sweeps with bounded memory
+        '''
+        space = self.space if space is None else space
+        return iter_samples(space, n_samples, method=method, chunk_size=chunk_size, seed=seed, **kwargs)
 
     def split(self, test_size=0.3):
         # train-test split on x, y, t
@@ -97,98 +226,249 @@ class DataHandler:
         self.y_test = self.y[split_index:]
         self.t_test = self.t[split_index:]
 
+    def save(self, path, dtype=None):
+        '''
+        path              -       file to write, conventionally with the .oodx extension
+        dtype             -       optional storage dtype for x, y, t, e.g. np.float32 to halve the file
+        '''
+        arrays = {}
+        for name in ('x', 'y', 't'):
+            arr = getattr(self, name)
+            if arr is not None:
+                arr = np.asarray(arr) if dtype is None else np.asarray(arr, dtype=dtype)
+                arrays[name] = np.ascontiguousarray(arr)
+        header = {
+            'version': 1,
+            'space': None if self.space is None else [list(map(float, val)) for val in self.space],
+            'moments': {
+                name: np.asarray(getattr(self, name), dtype=np.float64).tolist()
+                for name in _MOMENTS if getattr(self, name) is not None},
+            'arrays': {},
+        }
+        # lay the arrays out after the header, each starting on an aligned offset
+        offset = 0
+        for name, arr in arrays.items():
+            header['arrays'][name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+            offset += -(-arr.nbytes // _ALIGN) * _ALIGN
+        raw = json.dumps(header).encode()
+        start = -(-(len(_MAGIC) + 8 + len(raw)) // _ALIGN) * _ALIGN
+        raw = raw.ljust(start - len(_MAGIC) - 8)
+        with open(path, 'wb') as f:
+            f.write(_MAGIC + struct.pack('<Q', len(raw)) + raw)
+            for name, arr in arrays.items():
+                f.seek(start + header['arrays'][name]['offset'])
+                arr.tofile(f)
+            f.truncate(start + offset)
+
+    def load(self, path, mmap=True):
+        '''
+        path              -       file written by save()
+        mmap              -       if True x, y, t are read-only memory maps of the file, otherwise read into memory
+        '''
+        with open(path, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError('{} is not an oodx dataset file'.format(path))
+            length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(length))
+        start = len(_MAGIC) + 8 + length
+        self.__init__()
+        self.space = None if header['space'] is None else [tuple(val) for val in header['space']]
+        for name, val in header['moments'].items():
+            setattr(self, name, np.array(val))
+        for name, info in header['arrays'].items():
+            dtype, shape = np.dtype(info['dtype']), tuple(info['shape'])
+            if 0 in shape:
+                arr = np.empty(shape, dtype=dtype)
+            elif mmap:
+                arr = np.memmap(path, dtype=dtype, mode='r', offset=start + info['offset'], shape=shape)
+            else:
+                arr = np.fromfile(path, dtype=dtype, count=int(np.prod(shape)),
+                                  offset=start + info['offset']).reshape(shape)
+            setattr(self, name, arr)
+
     def scale(self):
         # normalise x
-        scaler = StandardScaler()
-        self.x_ = scaler.fit_transform(self.x)
-        self.x_mean, self.x_std = scaler.mean_, scaler.scale_
-        
+        self._moments['x'] = scaler = Scaler().fit(self.x)
+        self.x_ = scaler.transform(self.x)
+        self.x_mean, self.x_std = scaler.mean, scaler.std
+
         # normalise y only on converged data
-        y_con = self.y[self.t.ravel() == 1, :]
-        scaler.fit(y_con)
-        self.y_mean, self.y_std = scaler.mean_, scaler.scale_
-        self.y_ = (self.y - self.y_mean) / self.y_std
-        
+        self._moments['y'] = scaler = Scaler().fit(self.y[self.t.ravel() == 1, :])
+        self.y_mean, self.y_std = scaler.mean, scaler.std
+        self.y_ = scaler.transform(self.y)
+
         if self.x_train is not None:
-            # normalise x_train
-            self.x_train_ = scaler.fit_transform(self.x_train)
-            self.x_train_mean, self.x_train_std = scaler.mean_, scaler.scale_
-            # normalise x_test using training moments
-            self.x_test_ = (self.x_test - self.x_train_mean) / self.x_train_std
-            # normalise y_train only on converged data
-            y_train_con = self.y_train[self.t_train.ravel() == 1, :]
-            scaler.fit(y_train_con)
-            self.y_train_mean, self.y_train_std = scaler.mean_, scaler.scale_
-            self.y_train_ = (self.y_train - self.y_train_mean) / self.y_train_std
-            # normalise y_test using training moments
-            self.y_test_ = (self.y_test - self.y_train_mean) / self.y_train_std
-            # normalise space using training moments
-            self.space_ = [] 
-            for i, val in enumerate(self.space):
-                lb = (val[0] - self.x_train_mean[i]) / self.x_train_std[i]
-                ub = (val[1] - self.x_train_mean[i]) / self.x_train_std[i]
-                self.space_.append( (lb, ub) )
+            # normalise x_train, and x_test using training moments
+            self._moments['x_train'] = scaler = Scaler().fit(self.x_train)
+            self.x_train_mean, self.x_train_std = scaler.mean, scaler.std
+            self.x_train_ = scaler.transform(self.x_train)
+            self.x_test_ = scaler.transform(self.x_test)
+            # normalise y_train only on converged data, and y_test using training moments
+            self._moments['y_train'] = scaler = Scaler().fit(self.y_train[self.t_train.ravel() == 1, :])
+            self.y_train_mean, self.y_train_std = scaler.mean, scaler.std
+            self.y_train_ = scaler.transform(self.y_train)
+            self.y_test_ = scaler.transform(self.y_test)
+        # normalise space using training moments if available, else x moments
+        if self.space is not None:
+            self.space_ = self.scale_space(self.space)
+
+    def append(self, x_new, y_new=None, t_new=None):
+        '''
+        x_new             -       new input samples
+        y_new             -       new outputs, zeros if not given
+        t_new             -       new convergence flags, ones if not given
+        new samples extend x, y, t and, once split, the training set; scaling moments are updated
+        with a running merge and scaled arrays are refreshed in place, unless the moments are frozen
+        '''
+        x_new = np.asarray(x_new, dtype=np.float64).reshape(-1, self.x.shape[1])
+        k = x_new.shape[0]
+        y_shape = (k,) + self.y.shape[1:]
+        t_shape = (k,) + self.t.shape[1:]
+        y_new = np.zeros(y_shape) if y_new is None else np.asarray(y_new, dtype=np.float64).reshape(y_shape)
+        t_new = np.ones(t_shape) if t_new is None else np.asarray(t_new, dtype=np.float64).reshape(t_shape)
+        new = {'x': x_new, 'y': y_new, 't': t_new}
+        converged = t_new.ravel() == 1
+
+        # new samples join the full set and, once split, the training set
+        groups = ['', '_train'] if self.x_train is not None else ['']
+        for group in groups:
+            for name in ('x', 'y', 't'):
+                self._extend(name + group, new[name])
+            if 'x' + group in self._moments:
+                self._moments['x' + group].partial_fit(x_new)
+                self._moments['y' + group].partial_fit(y_new[converged])
+
+        if self.x_ is None:
+            return
+        if self.frozen:
+            # published moments stay fixed, only the new rows are scaled
+            for group in groups:
+                if getattr(self, 'x' + group + '_') is not None:
+                    self._extend('x' + group + '_', self._extend_scaler('x' + group).transform(x_new))
+                    self._extend('y' + group + '_', self._extend_scaler('y' + group).transform(y_new))
         else:
-            # normalise space using x moments
-            self.space_ = [] 
-            for i, val in enumerate(self.space):
-                lb = (val[0] - self.x_mean[i]) / self.x_std[i]
-                ub = (val[1] - self.x_mean[i]) / self.x_std[i]
-                self.space_.append((lb, ub))
+            self._publish()
+
+    def freeze(self, frozen=True):
+        ''' hold the published scaling moments fixed on append; unfreezing publishes the running moments '''
+        self.frozen = frozen
+        if not frozen and self.x_ is not None:
+            self._publish()
+
+    def _publish(self):
+        # expose the running moments and rescale every scaled array in place
+        for key, scaler in self._moments.items():
+            if scaler.mean is not None:
+                setattr(self, key + '_mean', scaler.mean)
+                setattr(self, key + '_std', scaler.std)
+        for scaled, raw, key in (
+                ('x_', 'x', 'x'), ('y_', 'y', 'y'),
+                ('x_train_', 'x_train', 'x_train'), ('y_train_', 'y_train', 'y_train'),
+                ('x_test_', 'x_test', 'x_train'), ('y_test_', 'y_test', 'y_train')):
+            if getattr(self, scaled) is not None:
+                buffer = self._buffer(scaled)
+                buffer.resize(getattr(self, raw).shape[0])
+                self._moments[key].transform(getattr(self, raw), out=buffer.view)
+                setattr(self, scaled, buffer.view)
+        if self.space is not None:
+            self.space_ = self.scale_space(self.space)
+
+    def _extend_scaler(self, key):
+        return Scaler(getattr(self, key + '_mean'), getattr(self, key + '_std'))
+
+    def _extend(self, name, rows):
+        buffer = self._buffer(name)
+        buffer.append(rows)
+        setattr(self, name, buffer.view)
+
+    def _buffer(self, name):
+        # storage is rebuilt whenever the attribute was reassigned outside append
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.view is not getattr(self, name):
+            buffer = _RowBuffer(getattr(self, name))
+            self._buffers[name] = buffer
+        return buffer
+
+    def x_scaler(self, dtype=np.float64):
+        ''' frozen copy of the active input moments: training moments once split, else x moments '''
+        if self.x_train is not None:
+            return self._frozen_scaler('x', self.x_train_mean, self.x_train_std, dtype)
+        return self._frozen_scaler('x', self.x_mean, self.x_std, dtype)
+
+    def y_scaler(self, dtype=np.float64):
+        ''' frozen copy of the active output moments: training moments once split, else y moments '''
+        if self.y_train is not None:
+            return self._frozen_scaler('y', self.y_train_mean, self.y_train_std, dtype)
+        return self._frozen_scaler('y', self.y_mean, self.y_std, dtype)
+
+    def _frozen_scaler(self, key, mean, std, dtype):
+        # reuse the handed-out scaler until the moments it was built from are replaced
+        key = (key, np.dtype(dtype))
+        cached = self._scalers.get(key)
+        if cached is None or cached[0] is not mean or cached[1] is not std:
+            cached = (mean, std, Scaler(mean, std, dtype=dtype, frozen=True))
+            self._scalers[key] = cached
+        return cached[2]
 
     def scale_space(self, space):
-        # normalise space using x moments
-        new_space = []
-        for i, val in enumerate(space):
-            if self.x_train is not None:
-                lb = (val[0] - self.x_train_mean[i]) / self.x_train_std[i]
-                ub = (val[1] - self.x_train_mean[i]) / self.x_train_std[i]
-            else:
-                lb = (val[0] - self.x_mean[i]) / self.x_std[i]
-                ub = (val[1] - self.x_mean[i]) / self.x_std[i]
-            new_space.append( [lb, ub] )
-        return new_space
-
-    def inv_scale_x(self, x):
-        output = np.zeros_like(x)
-        for i in range(x.shape[0]):
-            for j in range(x.shape[1]):
-                if self.x_train is not None:
-                    output[i, j] = x[i, j] * self.x_train_std[j] + self.x_train_mean[j]
-                else:
-                    output[i, j] = x[i, j] * self.x_std[j] + self.x_mean[j]
-        return output
-
-    def scale_x(self, x):
-        output = np.zeros_like(x)
-        for i in range(x.shape[0]):
-            for j in range(x.shape[1]):
-                if self.x_train is not None:
-                    output[i, j] = (x[i, j] - self.x_train_mean[j]) / self.x_train_std[j]
-                else:
-                    output[i, j] = (x[i, j] - self.x_mean[j]) / self.x_std[j]
-        return output
-
-    def inv_scale_y(self, y):
-        output = np.zeros_like(y)
+        return self.x_scaler().transform_space(space)
+
+    def inv_scale_x(self, x, out=None):
+        return self.x_scaler().inverse_transform(x, out=out)
+
+    def scale_x(self, x, out=None):
+        return self.x_scaler().transform(x, out=out)
+
+    def inv_scale_y(self, y, out=None):
+        y = np.asarray(y)
         if y.ndim == 1:
-            y.resize(y.shape[0], 1)
-            output = np.zeros_like(y)
-        for i in range(y.shape[0]):
-            for j in range(y.shape[1]):
-                if self.y_train is not None:
-                    output[i, j] = y[i, j] * self.y_train_std[j] + self.y_train_mean[j]
-                else:
-                    output[i, j] = y[i, j] * self.y_std[j] + self.y_mean[j]
-        return output
-
-    def scale_y(self, y):
-        output = np.zeros_like(y)
-        for i in range(y.shape[0]):
-            for j in range(y.shape[1]):
-                if self.x_train is not None:
-                    output[i, j] = (y[i, j] - self.y_train_mean[j]) / self.y_train_std[j]
-                else:
-                    output[i, j] = (y[i, j] - self.y_mean[j]) / self.y_std[j]
-        return output
-        
\ No newline at end of file
+            # single-output predictions come back as a column, the caller's array is left untouched
+            y = y.reshape(-1, 1)
+        return self.y_scaler().inverse_transform(y, out=out)
+
+    def scale_y(self, y, out=None):
+        y = np.asarray(y)
+        if y.ndim == 1:
+            y = y.reshape(-1, 1)
+        return self.y_scaler().transform(y, out=out)
+
+
+def read_space(path):
+    ''' parse a space file holding one "(lb, ub)" tuple per input dimension '''
+    space = []
+    pattern = re.compile(r'\((.*?)\)')
+    with open(path, 'r') as file:
+        for line in file:
+            match = pattern.search(line.strip())
+            if match:
+                space.append(tuple(map(float, match.group(1).split(','))))
+    return space
+
+
+def load_array(path, mmap=True):
+    ''' read a single array from a .npy file (memory-mapped if mmap) or a whitespace-delimited text file '''
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r' if mmap else None)
+    return np.loadtxt(path)
+
+
+def convert_text(out_path, x_path, y_path=None, t_path=None, space_path=None, dtype=None):
+    '''
+    one-shot conversion of text data files into a binary dataset store
+    out_path          -       dataset file to write
+    x_path            -       inputs, e.g. Data/x14_A2O.txt
+    y_path            -       outputs, e.g. Data/gas_A2O.txt
+    t_path            -       convergence flags, e.g. Data/t14_A2O.txt
+    space_path        -       input space, e.g. Data/space.txt
+    dtype             -       optional storage dtype for x, y, t
+    '''
+    data = DataHandler()
+    data.x = load_array(x_path)
+    if y_path is not None:
+        data.y = load_array(y_path)
+    if t_path is not None:
+        data.t = load_array(t_path)
+    if space_path is not None:
+        data.space = read_space(space_path)
+    data.save(out_path, dtype=dtype)
+    return data
@@ -1,16 +1,130 @@
 import pyomo.environ as pyo
+from pyomo.core.expr import sizeof_expression
 import numpy as np
 from scipy.special import kv, gamma
+from .gp import _rq, _matern
+
+
+def formulation_size(block):
+    '''
+    size of a constructed formulation block
+    returns a dict with the number of variables, binary variables, constraints and expression terms (nodes of
+    every constraint expression)
+    '''
+    variables = list(block.component_data_objects(pyo.Var, descend_into=True))
+    constraints = list(block.component_data_objects(pyo.Constraint, active=True, descend_into=True))
+    return {
+        'variables': len(variables),
+        'binaries': sum(v.is_binary() for v in variables),
+        'constraints': len(constraints),
+        'terms': sum(sizeof_expression(c.expr) for c in constraints),
+    }
+
+
+def _box_sq_dist(x_train, lo, hi):
+    # smallest and largest squared distance from each training sample to the box [lo, hi]
+    d2min = np.sum(np.maximum(np.maximum(lo - x_train, x_train - hi), 0) ** 2, axis=1)
+    d2max = np.sum(np.maximum((x_train - lo) ** 2, (x_train - hi) ** 2), axis=1)
+    return d2min, d2max
+
+
+def _power_bounds(lo, hi, p):
+    # interval of v ** p for integer p and v in [lo, hi]
+    if p % 2 == 1:
+        return lo ** p, hi ** p
+    straddle = (lo < 0) & (hi > 0)
+    return (np.where(straddle, 0, np.minimum(lo ** p, hi ** p)), np.maximum(lo ** p, hi ** p))
+
+
+def _big_m(bound, scale=1, shift=0):
+    # big-M scale * bound + shift of a neuron from a z bound, the former fixed 1e6 without one
+    return 1e6 if bound is None else max(scale * float(bound) + shift, 0)
+
+
+def _hull(lo, hi, breakpoints, pieces):
+    '''
+    linear inequalities (slope, intercept, sense) of the convex hull of a continuous piecewise linear activation
+    on [lo, hi], sense 1 for a >= slope z + intercept and -1 for a <=
+    '''
+    def f(z):
+        slope, intercept = pieces[int(np.searchsorted(breakpoints, z))]
+        return slope * z + intercept
+
+    points = [lo] + [point for point in breakpoints if lo < point < hi] + [hi]
+    points = [(z, f(z)) for z in points]
+    lines = []
+    for sense in (1, -1):
+        # lower convex and upper concave envelopes by a monotone chain
+        chain = []
+        for point in points:
+            while len(chain) >= 2 and sense * ((chain[-1][0] - chain[-2][0]) * (point[1] - chain[-2][1]) -
+                                               (chain[-1][1] - chain[-2][1]) * (point[0] - chain[-2][0])) <= 0:
+                chain.pop()
+            chain.append(point)
+        for (z0, a0), (z1, a1) in zip(chain[:-1], chain[1:]):
+            if z1 <= z0:
+                continue
+            slope = (a1 - a0) / (z1 - z0)
+            lines.append((slope, a0 - slope * z0, sense))
+    return lines
+
+
+def _lp_bounds(lp, var, solver, lo, hi, tol=1e-6):
+    # min and max of var over the LP relaxation, keeping the interval bound when a solve fails
+    bounds = []
+    for sense, default in ((pyo.minimize, lo), (pyo.maximize, hi)):
+        lp.obj = pyo.Objective(expr=var, sense=sense)
+        try:
+            result = solver.solve(lp, load_solutions=False)
+            if result.solver.termination_condition == pyo.TerminationCondition.optimal:
+                lp.solutions.load_from(result)
+                value = pyo.value(var) - tol if sense == pyo.minimize else pyo.value(var) + tol
+                default = max(default, value) if sense == pyo.minimize else min(default, value)
+        except (ValueError, RuntimeError):
+            pass
+        lp.del_component(lp.obj)
+        bounds.append(default)
+    return bounds
 
 
 class OODXBlock:
 
-    def __init__(self, model, data):
+    '''
+    model                 -       trained NN, GPR, SparseGPR, GPC or HybridModel
+    data                  -       DataHandler holding the training moments, None for models used in scaled space
+    '''
+    def __init__(self, model, data=None):
         self.model = model
         self.data = data
         self.formulation = None
-
-    def get_formulation(self, return_std=False):
+        self.kernel_vars = False
+        self.space = None
+        self.obbt = False
+        self.relu = 'bigm'
+        self.partitions = 2
+
+    def get_formulation(self, return_std=False, kernel_vars=False, space=None, obbt=False, relu='bigm', partitions=2):
+        '''
+        return_std            -       formulate the GPR variance term -k^T K^-1 k instead of the mean
+        kernel_vars           -       declare the GP kernel vector k_i as variables defined by one constraint each, so
+                                      quadratic forms in k are bilinear rather than built from repeated exponentials
+        space                 -       input space [[lb, ub], ...], its interval bounds are propagated through the
+                                      scaling, layers and kernels to bound every variable of the block
+        obbt                  -       tighten the ReLU, LeakyReLU and HardSigmoid neuron bounds by solving min/max z
+                                      LPs over the relaxed network, True for appsi_highs or a solver name, needs space
+        relu                  -       ReLU formulation, 'bigm', 'partition' splitting the inputs of each neuron into
+                                      partitions groups, or 'hull' the extended convex hull, the last two need space
+        partitions            -       number of input groups per neuron of the partition formulation
+        '''
+        if relu not in ('bigm', 'partition', 'hull'):
+            raise ValueError('unknown ReLU formulation {}'.format(relu))
+        if relu != 'bigm' and space is None:
+            raise ValueError('the {} ReLU formulation needs the input space'.format(relu))
+        self.kernel_vars = kernel_vars
+        self.space = space
+        self.obbt = obbt
+        self.relu = relu
+        self.partitions = partitions
         if self.model.name == 'NN' or self.model.name == 'NNClf':
             if self.model.activation == 'relu':
                 self.formulation = pyo.Block(rule=self._nn_relu_rule)
@@ -24,10 +138,10 @@ class OODXBlock:
                 self.formulation = pyo.Block(rule=self._nn_hardsigmoid_rule)
             elif self.model.activation == 'linear':
                 self.formulation = pyo.Block(rule=self._nn_linear_rule)
-            elif self.model.activation == 'leakyrelu':
+            elif self.model.activation in ('leakyrelu', 'leaky relu'):
                 self.formulation = pyo.Block(rule=self._nn_leakyrelu_rule)
 
-        elif self.model.name == 'GPR':
+        elif self.model.name == 'GPR' or self.model.name == 'SparseGPR':
             if self.model.kernel_name == 'rbf':
                 if return_std:
                     self.formulation = pyo.Block(rule=self._gpr_rbf_std_rule)
@@ -68,184 +182,177 @@ class OODXBlock:
 
         return self.formulation
 
-    def _gpr_rbf_rule(self, m):
-        # declare parameters
-        x_train = self.model.x_train
-        length_scale = self.model.length_scale
-        constant_value = self.model.constant_value
-        alpha = self.model.alpha
+    def _moments(self, n_inputs, n_outputs):
+        # training moments of the DataHandler, identity scaling without one
+        if self.data is None:
+            return np.zeros(n_inputs), np.ones(n_inputs), np.zeros(n_outputs), np.ones(n_outputs)
+        return self.data.x_train_mean, self.data.x_train_std, self.data.y_train_mean, self.data.y_train_std
 
+    def _declare_io(self, m, n_inputs, n_outputs, scale_outputs=True):
+        # user-space inputs and outputs, each tied once by a linear constraint to the scaled variables the
+        # kernel and layer expressions are written in
+        x_mean, x_std, y_mean, y_std = self._moments(len(n_inputs), len(n_outputs))
+        m.inputs = pyo.Var(n_inputs)
+        m.outputs = pyo.Var(n_outputs)
+        m.inputs_scaled = pyo.Var(n_inputs)
+        m.scale_inputs = pyo.Constraint(
+            n_inputs, rule=lambda m, j: m.inputs_scaled[j] == (m.inputs[j] - x_mean[j]) / x_std[j])
+        if scale_outputs:
+            m.outputs_scaled = pyo.Var(n_outputs)
+            m.scale_outputs = pyo.Constraint(
+                n_outputs, rule=lambda m, i: m.outputs[i] == m.outputs_scaled[i] * y_std[i] + y_mean[i])
+        if self.space is not None:
+            lb, ub = np.asarray(self.space, dtype=np.float64).T
+            lo, hi = self._input_box(len(n_inputs))
+            for j in n_inputs:
+                m.inputs[j].setlb(lb[j])
+                m.inputs[j].setub(ub[j])
+                m.inputs_scaled[j].setlb(lo[j])
+                m.inputs_scaled[j].setub(hi[j])
+
+    def _input_box(self, n_inputs):
+        # bounds of the scaled inputs, None without a space
+        if self.space is None:
+            return None
+        x_mean, x_std = self._moments(n_inputs, 1)[:2]
+        lb, ub = np.asarray(self.space, dtype=np.float64).T
+        return (lb - x_mean) / x_std, (ub - x_mean) / x_std
+
+    def _set_bounds(self, var, lo, hi):
+        for i, index in enumerate(sorted(var.index_set()) if var.is_indexed() else [None]):
+            var[index].setlb(float(lo[i]))
+            var[index].setub(float(hi[i]))
+
+    def _bound_outputs(self, m, lo, hi):
+        # scaled output interval and its image in user space, y_std is positive
+        self._set_bounds(m.outputs_scaled, lo, hi)
+        y_mean, y_std = self._moments(len(m.inputs), len(lo))[2:]
+        self._set_bounds(m.outputs, lo * y_std + y_mean, hi * y_std + y_mean)
+
+    def _kernel_bounds(self, n_inputs):
+        '''
+        elementwise bounds of the kernel vector k_i over the scaled input box, None without a space
+        stationary kernels decrease with the distance to x_i, so they are bounded by the nearest and farthest
+        points of the box, dot-product kernels by interval arithmetic on x . x_i
+        '''
+        box = self._input_box(n_inputs)
+        if box is None:
+            return None
+        lo, hi = box
+        x_train = self.model.x_train
+        model = self.model
+        if model.name == 'GPC':
+            d2min, d2max = _box_sq_dist(x_train, lo, hi)
+            return np.exp(-0.5 / model.l ** 2 * d2max), np.exp(-0.5 / model.l ** 2 * d2min)
+        c = model.constant_value
+        if model.kernel_name in ('linear', 'polynomial'):
+            dot_lo = model.sigma_0 ** 2 + np.minimum(x_train * lo, x_train * hi).sum(axis=1)
+            dot_hi = model.sigma_0 ** 2 + np.maximum(x_train * lo, x_train * hi).sum(axis=1)
+            if model.kernel_name == 'linear':
+                return c * dot_lo, c * dot_hi
+            pow_lo, pow_hi = _power_bounds(dot_lo, dot_hi, model.porder)
+            return c * pow_lo, c * pow_hi
+        if model.kernel_name == 'ExpSineSquared':
+            # sin^2 spans [0, 1] unless the box is narrow, bounded loosely by the kernel range
+            n = x_train.shape[0]
+            return np.full(n, c * np.exp(-2 / model.length_scale ** 2)), np.full(n, c)
+        d2min, d2max = _box_sq_dist(x_train, lo, hi)
+
+        def profile(d2):
+            if model.kernel_name == 'rbf':
+                return c * np.exp(-0.5 / model.length_scale ** 2 * d2)
+            elif model.kernel_name == 'RationalQuadratic':
+                return c * _rq(d2, model.length_scale, model.scale_mixture)
+            elif model.kernel_name == 'Matern':
+                return c * _matern(np.sqrt(d2), model.length_scale, model.nu)
+            elif model.kernel_name == 'Sum_RBF':
+                return c * (np.exp(-0.5 / model.length_scale ** 2 * d2) + np.exp(-0.5 / model.length_scale_1 ** 2 * d2))
+            return c * (_rq(d2, model.length_scale, model.scale_mixture) +
+                        _rq(d2, model.length_scale_1, model.scale_mixture_1))
+
+        return profile(d2max), profile(d2min)
+
+    def _gpr_mean(self, m, kernel):
         # declare sets
+        x_train = self.model.x_train
+        alpha = self.model.alpha
         n_samples = set(range(x_train.shape[0]))
         n_inputs = set(range(x_train.shape[1]))
         n_outputs = set(range(1))
 
         # declare variables
-        m.inputs = pyo.Var(n_inputs)
-        m.outputs = pyo.Var(n_outputs)
-
-        prediction = sum(alpha[i] * constant_value * pyo.exp(
-            -sum(
-                0.5 / length_scale ** 2 * ((m.inputs[j] - self.data.x_train_mean[j]) / self.data.x_train_std[j]  # scale
-                                           - x_train[i, j]) ** 2 for j in n_inputs)
-        ) for i in n_samples)
-
-        prediction = prediction * self.data.y_train_std[0] + self.data.y_train_mean[0]
+        self._declare_io(m, n_inputs, n_outputs)
 
         # gpr constraint
         m.gpr = pyo.Constraint(expr=
-                               m.outputs[0] == prediction
+                               m.outputs_scaled[0] == sum(alpha[i] * kernel(i) for i in n_samples)
                                )
 
+        bounds = self._kernel_bounds(len(n_inputs))
+        if bounds is not None:
+            # interval sum of alpha_i k_i
+            k_lo, k_hi = bounds
+            lo = np.minimum(alpha * k_lo, alpha * k_hi).sum()
+            hi = np.maximum(alpha * k_lo, alpha * k_hi).sum()
+            self._bound_outputs(m, np.array([lo]), np.array([hi]))
+
+    def _sq_dist(self, m, i):
+        # squared distance of the scaled inputs to training sample i
+        x_train = self.model.x_train
+        return sum((m.inputs_scaled[j] - x_train[i, j]) ** 2 for j in range(x_train.shape[1]))
+
+    def _gpr_rbf_rule(self, m):
+        # declare parameters
+        length_scale = self.model.length_scale
+        constant_value = self.model.constant_value
+
+        self._gpr_mean(m, lambda i: constant_value * pyo.exp(-0.5 / length_scale ** 2 * self._sq_dist(m, i)))
+
     def _gpr_linear_rule(self, m):
         # declare parameters
         x_train = self.model.x_train
         sigma_0 = self.model.sigma_0
         constant_value = self.model.constant_value
-        alpha = self.model.alpha
 
-        # declare sets
-        n_samples = set(range(x_train.shape[0]))
-        n_inputs = set(range(x_train.shape[1]))
-        n_outputs = set(range(1))
-
-        # declare variables
-        m.inputs = pyo.Var(n_inputs)
-        m.outputs = pyo.Var(n_outputs)
-
-        prediction = sum(alpha[i] * constant_value * (
-                sigma_0 ** 2 + sum((m.inputs[j] - self.data.x_train_mean[j]) / self.data.x_train_std[j]  # scale
-                                   * x_train[i, j] for j in n_inputs)
-        ) for i in n_samples)
-
-        prediction = prediction * self.data.y_train_std[0] + self.data.y_train_mean[0]
-
-        # gpr constraint        
-        m.gpr = pyo.Constraint(expr=
-                               m.outputs[0] == prediction
-                               )
+        self._gpr_mean(m, lambda i: constant_value * (
+                sigma_0 ** 2 + sum(m.inputs_scaled[j] * x_train[i, j] for j in range(x_train.shape[1]))))
 
     def _gpr_polynomial_rule(self, m):
         # declare parameters
         x_train = self.model.x_train
         sigma_0 = self.model.sigma_0
         constant_value = self.model.constant_value
-        alpha = self.model.alpha
         porder = self.model.porder
 
-        # declare sets
-        n_samples = set(range(x_train.shape[0]))
-        n_inputs = set(range(x_train.shape[1]))
-        n_outputs = set(range(1))
-
-        # declare variables
-        m.inputs = pyo.Var(n_inputs)
-        m.outputs = pyo.Var(n_outputs)
-
-        prediction = sum(alpha[i] * constant_value * (
-                sigma_0 ** 2 + sum((m.inputs[j] - self.data.x_train_mean[j]) / self.data.x_train_std[j]  # scale
-                                   * x_train[i, j] for j in n_inputs)
-        ) ** porder for i in n_samples)
-        prediction = prediction * self.data.y_train_std[0] + self.data.y_train_mean[0]
-
-        # gpr constraint        
-        m.gpr = pyo.Constraint(expr=
-                               m.outputs[0] == prediction
-                               )
+        self._gpr_mean(m, lambda i: constant_value * (
+                sigma_0 ** 2 + sum(m.inputs_scaled[j] * x_train[i, j] for j in range(x_train.shape[1]))) ** porder)
 
     def _gpr_rq_rule(self, m):
         # declare parameters
-        x_train = self.model.x_train
-        alpha = self.model.alpha
         constant_value = self.model.constant_value
         length_scale = self.model.length_scale
         scale_mixture = self.model.scale_mixture
 
-        # declare sets
-        n_samples = set(range(x_train.shape[0]))
-        n_inputs = set(range(x_train.shape[1]))
-        n_outputs = set(range(1))
-
-        # declare variables
-        m.inputs = pyo.Var(n_inputs)
-        m.outputs = pyo.Var(n_outputs)
-
-        prediction = sum(
-            alpha[i] * constant_value * (
-                    1 + sum(
-                (
-                        (m.inputs[j] - self.data.x_train_mean[j]) / self.data.x_train_std[j]  # scale
-                        - x_train[i, j]
-                ) ** 2 / (2 * scale_mixture * length_scale ** 2) for j in n_inputs
-            )
-            ) ** (-scale_mixture) for i in n_samples)
-        prediction = prediction * self.data.y_train_std[0] + self.data.y_train_mean[0]
-
-        # gpr constraint
-        m.gpr = pyo.Constraint(expr=
-                               m.outputs[0] == prediction
-                               )
+        self._gpr_mean(m, lambda i: constant_value * (
+                1 + self._sq_dist(m, i) / (2 * scale_mixture * length_scale ** 2)) ** (-scale_mixture))
 
     def _gpr_ess_rule(self, m):
         # declare parameters
-        x_train = self.model.x_train
-        alpha = self.model.alpha
         constant_value = self.model.constant_value
         length_scale = self.model.length_scale
         periodicity = self.model.periodicity
 
-        # declare sets
-        n_samples = set(range(x_train.shape[0]))
-        n_inputs = set(range(x_train.shape[1]))
-        n_outputs = set(range(1))
-
-        # declare variables
-        m.inputs = pyo.Var(n_inputs)
-        m.outputs = pyo.Var(n_outputs)
-
-        prediction = sum(
-            alpha[i] * constant_value * pyo.exp(
-                -2 * pyo.sin(
-                    np.pi / periodicity * pyo.sqrt(
-                        sum(
-                            (
-                                    (m.inputs[j] - self.data.x_train_mean[j]) / self.data.x_train_std[j]
-                                    - x_train[i, j]
-                            ) ** 2 for j in n_inputs
-                        )
-                    )
-                ) ** 2
-
-            ) for i in n_samples
-        )
-        prediction = prediction * self.data.y_train_std[0] + self.data.y_train_mean[0]
-
-        # gor constraint
-        m.gpr = pyo.Constraint(expr=
-                               m.outputs[0] == prediction
-                               )
+        self._gpr_mean(m, lambda i: constant_value * pyo.exp(
+            -2 / length_scale ** 2 * pyo.sin(np.pi / periodicity * pyo.sqrt(self._sq_dist(m, i))) ** 2))
 
     def _gpr_matern_rule(self, m):
         # declare parameters
-        x_train = self.model.x_train
         length_scale = self.model.length_scale
         nu = self.model.nu
         constant_value = self.model.constant_value
-        alpha = self.model.alpha
-
-        # declare sets
-        n_samples = set(range(x_train.shape[0]))
-        n_inputs = set(range(x_train.shape[1]))
-        n_outputs = set(range(1))
-
-        # declare variables
-        m.inputs = pyo.Var(n_inputs)
-        m.outputs = pyo.Var(n_outputs)
 
         def matern_kernel(i):
-            distance = pyo.sqrt(sum(((m.inputs[j] - self.data.x_train_mean[j]) / self.data.x_train_std[j]
-                                     - x_train[i, j]) ** 2 for j in n_inputs))
-            factor = np.sqrt(2 * nu) * distance / length_scale
+            factor = np.sqrt(2 * nu) * pyo.sqrt(self._sq_dist(m, i)) / length_scale
             if nu == 0.5:
                 return pyo.exp(-factor)
             elif nu == 1.5:
@@ -253,100 +360,50 @@ class OODXBlock:
             elif nu == 2.5:
                 return (1 + factor + factor ** 2 / 3) * pyo.exp(-factor)
             else:
-                # Here we can't use scipy's kv directly, so we need to precompute or use another approach
-                # For simplicity, let's assume nu is one of the handled values
-                # In real scenarios, handle or precompute kv values for non-handled nu
+                # the Bessel function of the general Matern kernel has no algebraic form
                 raise NotImplementedError("nu value not handled in this implementation")
 
-        prediction = sum(
-            alpha[i] * constant_value * matern_kernel(i)
-            for i in n_samples
-        )
-
-        prediction = prediction * self.data.y_train_std[0] + self.data.y_train_mean[0]
-
-        # gpr constraint
-        m.gpr = pyo.Constraint(expr=
-                               m.outputs[0] == prediction
-                               )
+        self._gpr_mean(m, lambda i: constant_value * matern_kernel(i))
 
     def _gpr_sum_rbf_rule(self, m):
         # declare parameters
-        x_train = self.model.x_train
         length_scale = self.model.length_scale
         length_scale_1 = self.model.length_scale_1
         constant_value = self.model.constant_value
-        alpha = self.model.alpha
-
-        # declare sets
-        n_samples = set(range(x_train.shape[0]))
-        n_inputs = set(range(x_train.shape[1]))
-        n_outputs = set(range(1))
-
-        # declare variables
-        m.inputs = pyo.Var(n_inputs)
-        m.outputs = pyo.Var(n_outputs)
-
-        prediction = sum(alpha[i] * constant_value * (pyo.exp(
-            -sum(
-                0.5 / length_scale ** 2 * ((m.inputs[j] - self.data.x_train_mean[j]) / self.data.x_train_std[j]  # scale
-                                           - x_train[i, j]) ** 2 for j in n_inputs)
-        ) + pyo.exp(
-            -sum(
-                0.5 / length_scale_1 ** 2 * (
-                        (m.inputs[j] - self.data.x_train_mean[j]) / self.data.x_train_std[j]  # scale
-                        - x_train[i, j]) ** 2 for j in n_inputs)
-        )) for i in n_samples)
 
-        prediction = prediction * self.data.y_train_std[0] + self.data.y_train_mean[0]
-
-        # gpr constraint
-        m.gpr = pyo.Constraint(expr=
-                               m.outputs[0] == prediction
-                               )
+        self._gpr_mean(m, lambda i: constant_value * (
+                pyo.exp(-0.5 / length_scale ** 2 * self._sq_dist(m, i)) +
+                pyo.exp(-0.5 / length_scale_1 ** 2 * self._sq_dist(m, i))))
 
     def _gpr_sum_rq_rule(self, m):
         # declare parameters
-        x_train = self.model.x_train
-        alpha = self.model.alpha
         constant_value = self.model.constant_value
         length_scale = self.model.length_scale
         length_scale_1 = self.model.length_scale_1
         scale_mixture = self.model.scale_mixture
         scale_mixture_1 = self.model.scale_mixture_1
-        # declare sets
-        n_samples = set(range(x_train.shape[0]))
-        n_inputs = set(range(x_train.shape[1]))
-        n_outputs = set(range(1))
 
-        # declare variables
-        m.inputs = pyo.Var(n_inputs)
-        m.outputs = pyo.Var(n_outputs)
-
-        prediction = sum(
-            alpha[i] * constant_value * ((
-                                                 1 + sum(
-                                             (
-                                                     (m.inputs[j] - self.data.x_train_mean[j]) / self.data.x_train_std[
-                                                 j]  # scale
-                                                     - x_train[i, j]
-                                             ) ** 2 / (2 * scale_mixture * length_scale ** 2) for j in n_inputs
-                                         )
-                                         ) ** (-scale_mixture) + (
-                                                 1 + sum(
-                                             (
-                                                     (m.inputs[j] - self.data.x_train_mean[j]) / self.data.x_train_std[
-                                                 j]  # scale
-                                                     - x_train[i, j]
-                                             ) ** 2 / (2 * scale_mixture_1 * length_scale_1 ** 2) for j in n_inputs
-                                         )
-                                         ) ** (-scale_mixture_1)) for i in n_samples)
-        prediction = prediction * self.data.y_train_std[0] + self.data.y_train_mean[0]
-
-        # gpr constraint
-        m.gpr = pyo.Constraint(expr=
-                               m.outputs[0] == prediction
-                               )
+        self._gpr_mean(m, lambda i: constant_value * (
+                (1 + self._sq_dist(m, i) / (2 * scale_mixture * length_scale ** 2)) ** (-scale_mixture) +
+                (1 + self._sq_dist(m, i) / (2 * scale_mixture_1 * length_scale_1 ** 2)) ** (-scale_mixture_1)))
+
+    def _kernel_vector(self, m, n_samples, kernel, bounds=(None, None)):
+        # kernel vector k_i as expressions, or with kernel_vars as variables each tied to its expression once
+        if not self.kernel_vars:
+            return {i: kernel(i) for i in n_samples}
+        m.k = pyo.Var(n_samples, bounds=bounds)
+        m.k_def = pyo.Constraint(n_samples, rule=lambda m, i: m.k[i] == kernel(i))
+        box_bounds = self._kernel_bounds(len(m.inputs))
+        if box_bounds is not None:
+            self._set_bounds(m.k, *box_bounds)
+        return m.k
+
+    def _quad_form(self, k, M, n_samples):
+        # k^T M k, with kernel_vars a single bilinear form over the symmetric M counting each pair i < j once
+        if not self.kernel_vars:
+            return sum(k[i] * sum(M[i, j] * k[j] for j in n_samples) for i in n_samples)
+        return pyo.quicksum(
+            (M[i, i] * k[i] ** 2 if i == j else 2 * M[i, j] * k[i] * k[j]) for i in n_samples for j in n_samples if i <= j)
 
     def _gpr_rbf_std_rule(self, m):
         # declare parameters
@@ -361,24 +418,14 @@ class OODXBlock:
         n_outputs = set(range(1))
 
         # declare variables
-        m.inputs = pyo.Var(n_inputs)
-        m.outputs = pyo.Var(n_outputs)
+        self._declare_io(m, n_inputs, n_outputs, scale_outputs=False)
+
+        k = self._kernel_vector(m, n_samples, lambda i: constant_value * pyo.exp(
+            -0.5 / length_scale ** 2 * self._sq_dist(m, i)), bounds=(0, constant_value))
 
         # gpr constraint representing -k^T K^-1 k in the std calc
         m.gpr_std = pyo.Constraint(expr=
-                                   m.outputs[0] == - sum(
-                                       constant_value * pyo.exp(-sum(
-                                           0.5 / length_scale ** 2 * (
-                                                   m.inputs[j] - x_train[i, j]
-                                           ) ** 2 for j in n_inputs
-                                       )) * sum(
-                                           inv_K[i, k] * constant_value * pyo.exp(-sum(
-                                               0.5 / length_scale ** 2 * (
-                                                       m.inputs[j] - x_train[k, j]
-                                               ) ** 2 for j in n_inputs
-                                           )) for k in n_samples
-                                       ) for i in n_samples
-                                   )
+                                   m.outputs[0] == - self._quad_form(k, inv_K, n_samples)
                                    )
 
     def _gpr_linear_std_rule(self, m):
@@ -394,18 +441,14 @@ class OODXBlock:
         n_outputs = set(range(1))
 
         # declare variables
-        m.inputs = pyo.Var(n_inputs)
-        m.outputs = pyo.Var(n_outputs)
+        self._declare_io(m, n_inputs, n_outputs, scale_outputs=False)
+
+        k = self._kernel_vector(m, n_samples, lambda i: constant_value * (
+                sigma_0 ** 2 + sum(m.inputs_scaled[j] * x_train[i, j] for j in n_inputs)))
 
         # gpr constraint representing -k^T K^-1 k in the std calc
         m.gpr_std = pyo.Constraint(expr=
-                                   m.outputs[0] == - sum(
-                                       constant_value * (
-                                               sigma_0 ** 2 + sum(m.inputs[j] * x_train[i, j] for j in range(m)))
-                                       * sum(inv_K[i, k] * constant_value * (
-                                               sigma_0 ** 2 + sum(m.inputs[j] * x_train[k, j] for j in range(m)))
-                                             for k in n_samples) for i in n_samples
-                                   )
+                                   m.outputs[0] == - self._quad_form(k, inv_K, n_samples)
                                    )
 
     def _gpr_polynomial_std_rule(self, m):
@@ -422,18 +465,14 @@ class OODXBlock:
         n_outputs = set(range(1))
 
         # declare variables
-        m.inputs = pyo.Var(n_inputs)
-        m.outputs = pyo.Var(n_outputs)
+        self._declare_io(m, n_inputs, n_outputs, scale_outputs=False)
+
+        k = self._kernel_vector(m, n_samples, lambda i: constant_value * (
+                sigma_0 ** 2 + sum(m.inputs_scaled[j] * x_train[i, j] for j in n_inputs)) ** porder)
 
         # gpr constraint representing -k^T K^-1 k in the std calc
         m.gpr_std = pyo.Constraint(expr=
-                                   m.outputs[0] == - sum(
-                                       constant_value * (sigma_0 ** 2 + sum(
-                                           m.inputs[j] * x_train[i, j] for j in range(m))) ** porder
-                                       * sum(inv_K[i, k] * constant_value * (sigma_0 ** 2 + sum(
-                                           m.inputs[j] * x_train[k, j] for j in range(m))) ** porder
-                                             for k in n_samples) for i in n_samples
-                                   )
+                                   m.outputs[0] == - self._quad_form(k, inv_K, n_samples)
                                    )
 
     def _gpc_rule(self, m):
@@ -441,7 +480,7 @@ class OODXBlock:
         x_train = self.model.x_train
         length_scale = self.model.l
         constant_value = self.model.sigma_f ** 2
-        delta = self.model.delta
+        delta = np.ravel(self.model.delta)
         invP = self.model.inv_P
 
         # declare sets
@@ -450,476 +489,291 @@ class OODXBlock:
         n_outputs = set(range(1))
 
         # declare variables
-        m.inputs = pyo.Var(n_inputs)
-        m.outputs = pyo.Var(n_outputs)
+        self._declare_io(m, n_inputs, n_outputs, scale_outputs=False)
+
+        # unit squared exponential per training sample, shared by the mean and the variance
+        k = self._kernel_vector(m, n_samples, lambda i: pyo.exp(
+            -0.5 / length_scale ** 2 * self._sq_dist(m, i)), bounds=(0, 1))
 
         # gpc constraint
         m.gpc = pyo.Constraint(expr=
                                m.outputs[0] ==
-                               1 / (1 + pyo.exp(-constant_value * sum(
-                                   delta[j] * pyo.exp(-sum(
-                                       0.5 / length_scale ** 2 * (m.inputs[i] - x_train[j, i]) ** 2
-                                       for i in n_inputs)) for j in n_samples) / pyo.sqrt(
-                                   1 + 3.1416 / 8 * constant_value * (1 - sum(
-                                       pyo.exp(-sum(0.5 / length_scale ** 2 * (
-                                               m.inputs[i] - x_train[j, i]) ** 2
-                                                    for i in n_inputs)) * constant_value * sum(
-                                           pyo.exp(-sum(0.5 / length_scale ** 2 * (
-                                                   m.inputs[j] - x_train[k, j]) ** 2
-                                                        for j in n_inputs)) * invP[j, k]
-                                           for k in n_samples) for j in n_samples))))))
-
-    def _nn_general(self, m):
+                               1 / (1 + pyo.exp(-constant_value * sum(delta[i] * k[i] for i in n_samples) / pyo.sqrt(
+                                   1 + 3.1416 / 8 * constant_value * (
+                                           1 - constant_value * self._quad_form(k, invP, n_samples))))))
+        if self.space is not None:
+            m.outputs[0].setlb(0)
+            m.outputs[0].setub(1)
+
+    def _nn_general(self, m, activation, bound, binaries=None, pieces=None):
+        '''
+        layers shared by every NN rule, z = W a + b from the scaled inputs up to the linear output layer
+        activation            -       function (m, l, n) adding the constraints tying a[l, n] to z[l, n]
+        bound                 -       the activation on numpy arrays, monotone so that it maps z bounds to a bounds
+        binaries              -       {name: breakpoint} of the binary variables of a piecewise linear activation,
+                                      declared only for neurons whose z bounds straddle the breakpoint
+        pieces                -       (slope, intercept) of the activation between the sorted breakpoints, a neuron
+                                      whose z bounds lie within one piece is substituted by that affine function
+        '''
         # declare parameters
         W = self.model.weights
         b = self.model.biases
+        binaries = binaries or {}
+        breakpoints = sorted(binaries.values())
 
         # declare sets
         m.layers = list(range(len(self.model.layers)))
         m.nodes = {layer: set(range(nodes)) for layer, nodes in enumerate(self.model.layers)}
-
-        # declare variables
-        m.inputs = pyo.Var(m.nodes[0])
-        m.z = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.a = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.outputs = pyo.Var(m.nodes[len(self.model.layers) - 1])
+        last = len(m.layers) - 1
+        hidden = [(l, n) for l in m.layers[1:last] for n in sorted(m.nodes[l])]
+        z_lo, z_hi = self._nn_bounds(bound, breakpoints, pieces)
+
+        # in a pruned network a neuron whose inputs are all zero weights or constant neurons is a constant, and one
+        # without a nonzero weight to a used neuron of the next layer is not used at all
+        stable = {}
+        for (l, n) in hidden:
+            if all(W[l - 1][n, k] == 0 or (l - 1, k) in stable for k in m.nodes[l - 1]):
+                value = b[l - 1][n] + sum(W[l - 1][n, k] * stable[(l - 1, k)][1] for k in m.nodes[l - 1]
+                                          if W[l - 1][n, k] != 0)
+                stable[(l, n)] = (0, float(bound(value)))
+        used = {(last, n) for n in m.nodes[last]}
+        for l in reversed(m.layers[1:last]):
+            used |= {(l, k) for k in m.nodes[l] if any(W[l][n, k] != 0 for n in m.nodes[l + 1] if (l + 1, n) in used)}
+        hidden = [i for i in hidden if i in used]
+
+        # a neuron is stable when no breakpoint lies strictly inside its z bounds
+        if z_lo is not None and pieces is not None:
+            for (l, n) in hidden:
+                if (l, n) in stable:
+                    continue
+                lo, hi = z_lo[l][n], z_hi[l][n]
+                if not any(lo < point < hi for point in breakpoints):
+                    stable[(l, n)] = pieces[int(np.searchsorted(breakpoints, 0.5 * (lo + hi)))]
+
+        # declare variables, a feature extractor of a hybrid model has no output scaling
+        scale_outputs = self.model.name != 'Hybrid'
+        self._declare_io(m, m.nodes[0], m.nodes[last], scale_outputs=scale_outputs)
+        outputs = m.outputs_scaled if scale_outputs else m.outputs
+        m.z = pyo.Var([(l, n) for l in m.layers[1:] for n in sorted(m.nodes[l])
+                       if (l, n) in used and ((l, n) not in stable or stable[(l, n)][0] != 0)])
+        m.a = pyo.Var([i for i in hidden if i not in stable])
+        for name, point in binaries.items():
+            m.add_component(name, pyo.Var(
+                [i for i in m.a if z_lo is None or z_lo[i[0]][i[1]] < point < z_hi[i[0]][i[1]]], domain=pyo.Binary))
+        if z_lo is not None:
+            for (l, n) in m.z:
+                m.z[(l, n)].setlb(float(z_lo[l][n]))
+                m.z[(l, n)].setub(float(z_hi[l][n]))
+            for (l, n) in m.a:
+                m.a[(l, n)].setlb(float(bound(z_lo[l][n])))
+                m.a[(l, n)].setub(float(bound(z_hi[l][n])))
+
+        def output(l, n):
+            # activation of neuron (l, n) as seen by the next layer
+            if (l, n) not in used:
+                return 0
+            if (l, n) not in stable:
+                return m.a[(l, n)]
+            slope, intercept = stable[(l, n)]
+            if slope == 0:
+                return intercept
+            return slope * m.z[(l, n)] + intercept if (slope, intercept) != (1, 0) else m.z[(l, n)]
+
+        # inputs of every layer, the scaled inputs and then the activations of the previous layer, with their bounds
+        m.layer_inputs = {l: [m.inputs_scaled[k] if l == 1 else output(l - 1, k) for k in sorted(m.nodes[l - 1])]
+                          for l in m.layers[1:]}
+        if z_lo is not None:
+            m.input_bounds = {l: self._input_box(len(m.nodes[0])) if l == 1 else (bound(z_lo[l - 1]), bound(z_hi[l - 1]))
+                              for l in m.layers[1:]}
 
         # constraints
         m.c = pyo.ConstraintList()
 
-        for n in m.nodes[1]:
-            m.c.add(m.z[(1, n)] == sum(W[0][n, k] * m.inputs[k] for k in m.nodes[0]) + b[0][n])
-
         for l in m.layers[1:]:
-            for n in m.nodes[l]:
-                m.c.add(m.z[(l, n)] == sum(W[l - 1][n, k] * m.a[(l - 1, k)] for k in m.nodes[l - 1]) + b[l - 1][n])
-
-        for n in m.nodes[len(self.model.layers) - 1]:
-            m.c.add(m.outputs[n] == m.z[(len(self.model.layers) - 1, n)])
-
-    def _nn_linear_rule(self, m):
-        W = self.model.weights
-        b = self.model.biases
-
-        m.layers = list(range(len(self.model.layers)))
-        m.nodes = {layer: set(range(nodes)) for layer, nodes in enumerate(self.model.layers)}
-
-        last = len(m.layers) - 1
-
-        m.inputs = pyo.Var(m.nodes[0])
-        m.outputs = pyo.Var(m.nodes[len(self.model.layers) - 1])
-
-        m.z = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.a = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.c = pyo.ConstraintList()
-
-        for n in m.nodes[1]:
-            m.c.add(m.z[(1, n)] == sum(W[0][n, k] * (m.inputs[k] - self.data.x_train_mean[k]) / self.data.x_train_std[k]
-                                       for k in m.nodes[0]) + b[0][n])
-            m.c.add(m.a[(1, n)] == m.z[(1, n)])
-
-        for l in m.layers[2:]:
-            for n in m.nodes[l]:
-                m.c.add(m.z[(l, n)] == sum(W[l - 1][n, k] * m.a[(l - 1, k)] for k in m.nodes[l - 1]) + b[l - 1][n])
-                m.c.add(m.a[(l, n)] == m.z[(l, n)])
+            for n in sorted(m.nodes[l]):
+                if (l, n) not in m.z:
+                    continue
+                m.c.add(m.z[(l, n)] == sum(
+                    W[l - 1][n, k] * x for k, x in enumerate(m.layer_inputs[l]) if W[l - 1][n, k] != 0) + b[l - 1][n])
+                if (l, n) in m.a:
+                    activation(m, l, n)
 
         for n in m.nodes[last]:
-            m.c.add(m.outputs[n] == m.z[(last, n)] * self.data.y_train_std[n] + self.data.y_train_mean[n])
-
-        # # retrieve general  model
-        # m. = pyo.Block(rule=self.__general)
-        #
-        # # declare variables
-        # m.inputs = pyo.Var(m..nodes[0])
-        # m.outputs = pyo.Var(m..nodes[len(self.model.layers) - 1])
-        #
-        # # constraints
-        # m.c = pyo.ConstraintList()
-        #
-        # # activated layers return tanh of linear outputs
-        # for l in m..layers[1:]:
-        #     for n in m..nodes[l]:
-        #         m.c.add(m..a[(l, n)] == m..z[(l, n)])
-        #
-        # # coect inputs to general model
-        # for i in m..nodes[0]:
-        #     m.c.add(m.inputs[i] == m..inputs[i])
-        #
-        # # coect outputs to general model
-        # for i in m..nodes[len(self.model.layers) - 1]:
-        #     m.c.add(m.outputs[i] == m..outputs[i])
+            m.c.add(outputs[n] == m.z[(last, n)])
 
-    def _nn_tanh_rule(self, m):
+        if z_lo is not None:
+            if scale_outputs:
+                self._bound_outputs(m, z_lo[last], z_hi[last])
+            else:
+                self._set_bounds(m.outputs, z_lo[last], z_hi[last])
+
+    def _nn_bounds(self, bound, breakpoints, pieces):
+        '''
+        pre-activation bounds {layer: (lo, hi)} over the input space by interval arithmetic, tightened by LP
+        optimisation based bound tightening when obbt is set and the activation is piecewise linear
+        returns None, None without a space
+        '''
+        box = self._input_box(self.model.layers[0])
+        if box is None:
+            return None, None
         W = self.model.weights
         b = self.model.biases
+        last = len(self.model.layers) - 1
+        z_lo, z_hi = {}, {}
+        lo, hi = box
+        lp = None
+        if self.obbt and pieces is not None:
+            solver = pyo.SolverFactory('appsi_highs' if self.obbt is True else self.obbt)
+            lp = pyo.ConcreteModel()
+            lp.c = pyo.ConstraintList()
+            lp.x = pyo.Var(range(len(lo)), bounds=lambda lp, j: (lo[j], hi[j]))
+            lp.z = pyo.Var([(l, n) for l in range(1, last) for n in range(self.model.layers[l])])
+            lp.a = pyo.Var(lp.z.index_set())
+            prev = [lp.x[j] for j in range(len(lo))]
+        for l in range(1, last + 1):
+            # interval propagation, z = W a + b takes the lower bound of a where W > 0 and the upper where W < 0
+            Wp, Wn = np.maximum(W[l - 1], 0), np.minimum(W[l - 1], 0)
+            z_lo[l], z_hi[l] = Wp @ lo + Wn @ hi + b[l - 1], Wp @ hi + Wn @ lo + b[l - 1]
+            if lp is not None and l < last:
+                # z of this layer over the relaxation of the previous ones, then its own relaxation on the new bounds
+                nodes = range(self.model.layers[l])
+                for n in nodes:
+                    z = lp.z[(l, n)]
+                    lp.c.add(z == sum(W[l - 1][n, k] * prev[k] for k in range(len(prev))) + b[l - 1][n])
+                    # the first layer is affine in the input box, its interval bounds are already exact
+                    if l > 1 and any(z_lo[l][n] < point < z_hi[l][n] for point in breakpoints):
+                        z_lo[l][n], z_hi[l][n] = _lp_bounds(lp, z, solver, z_lo[l][n], z_hi[l][n])
+                    z.setlb(z_lo[l][n])
+                    z.setub(z_hi[l][n])
+                for n in nodes:
+                    a = lp.a[(l, n)]
+                    a.setlb(float(bound(z_lo[l][n])))
+                    a.setub(float(bound(z_hi[l][n])))
+                    for slope, intercept, sense in _hull(z_lo[l][n], z_hi[l][n], breakpoints, pieces):
+                        lp.c.add(sense * (a - slope * lp.z[(l, n)] - intercept) >= 0)
+                prev = [lp.a[(l, n)] for n in nodes]
+            lo, hi = bound(z_lo[l]), bound(z_hi[l])
+        return z_lo, z_hi
 
-        m.layers = list(range(len(self.model.layers)))
-
-        m.nodes = {layer: set(range(nodes)) for layer, nodes in enumerate(self.model.layers)}
-
-        last = len(m.layers) - 1
-
-        m.inputs = pyo.Var(m.nodes[0])
-        m.outputs = pyo.Var(m.nodes[len(self.model.layers) - 1])
-
-        m.z = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.a = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.c = pyo.ConstraintList()
+    def _nn_linear_rule(self, m):
+        def activation(m, l, n):
+            m.c.add(m.a[(l, n)] == m.z[(l, n)])
 
-        for n in m.nodes[1]:
-            m.c.add(m.z[(1, n)] == sum(W[0][n, k] * (m.inputs[k] - self.data.x_train_mean[k]) / self.data.x_train_std[k]
-                                       for k in m.nodes[0]) + b[0][n])
-            m.c.add(m.a[(1, n)] == 1 - 2 / (pyo.exp(2 * m.z[(1, n)]) + 1))
+        self._nn_general(m, activation, lambda z: z)
 
-        for l in m.layers[2:]:
-            for n in m.nodes[l]:
-                m.c.add(m.z[(l, n)] == sum(W[l - 1][n, k] * m.a[(l - 1, k)] for k in m.nodes[l - 1]) + b[l - 1][n])
-                m.c.add(m.a[(l, n)] == 1 - 2 / (pyo.exp(2 * m.z[(l, n)]) + 1))
+    def _nn_tanh_rule(self, m):
+        def activation(m, l, n):
+            m.c.add(m.a[(l, n)] == 1 - 2 / (pyo.exp(2 * m.z[(l, n)]) + 1))
 
-        for n in m.nodes[last]:
-            m.c.add(m.outputs[n] == m.z[(last, n)] * self.data.y_train_std[n] + self.data.y_train_mean[n])
-
-        # z = {(i, j): 0.0 for i in m.layers for j in m.nodes[i]}
-        # a = {(i, j): 0.0 for i in m.layers for j in m.nodes[i]}
-        #
-        # for n in m.nodes[1]:
-        #     z[(1, n)] = sum(W[0][n, k] * (m.inputs[k] - self.data.x_train_mean[k]) / self.data.x_train_std[k]
-        #                     for k in m.nodes[0]) + b[0][n]
-        #     a[(1, n)] = 1 - 2 / (pyo.exp(2 * z[(1, n)]) + 1)
-        #
-        # for l in m.layers[2:]:
-        #     for n in m.nodes[l]:
-        #         z[(l, n)] = sum(W[l - 1][n, k] * a[(l - 1, k)] for k in m.nodes[l - 1]) + b[l - 1][n]
-        #         a[(l, n)] = 1 - 2 / (pyo.exp(2 * z[(l, n)]) + 1)
-        #
-        # m.c = pyo.Constraint(expr=m.outputs[0] == z[(last, 0)] * self.data.y_train_std[0] + self.data.y_train_mean[0])
-
-        # for n in m.nodes[1]:
-        #     m.z[(1, n)] = sum(W[0][n, k] * m.inputs[k] for k in m.nodes[0]) + b[0][n]
-        #     m.a[(1, n)] = 1 - 2 / (pyo.exp(2 * m.z[(1, n)]))
-        #
-        # for l in m.layers[1:]:
-        #     for n in m.nodes[l]:
-        #         print(l, n)
-
-        # # retrieve general  model
-        # m. = pyo.Block(rule=self.__general)
-        #
-        # # declare variables
-        # m.inputs = pyo.Var(m..nodes[0])
-        # m.outputs = pyo.Var(m..nodes[len(self.model.layers) - 1])
-        #
-        # # constraints
-        # m.c = pyo.ConstraintList()
-        #
-        # # activated layers return tanh of linear outputs
-        # for l in m..layers[1:]:
-        #     for n in m..nodes[l]:
-        #         m.c.add(m..a[(l, n)] == 1 - 2 / (pyo.exp(2 * m..z[(l, n)]) + 1))
-        #
-        # # coect inputs to general model
-        # for i in m..nodes[0]:
-        #     m.c.add(m.inputs[i] == m..inputs[i])
-        #
-        # # coect outputs to general model
-        # for i in m..nodes[len(self.model.layers) - 1]:
-        #     m.c.add(m.outputs[i] == m..outputs[i])
+        self._nn_general(m, activation, np.tanh)
 
     def _nn_sigmoid_rule(self, m):
-        W = self.model.weights
-        b = self.model.biases
-
-        m.layers = list(range(len(self.model.layers)))
-        m.nodes = {layer: set(range(nodes)) for layer, nodes in enumerate(self.model.layers)}
-
-        last = len(m.layers) - 1
-
-        m.inputs = pyo.Var(m.nodes[0])
-        m.outputs = pyo.Var(m.nodes[len(self.model.layers) - 1])
+        def activation(m, l, n):
+            m.c.add(m.a[(l, n)] == 1 / (1 + pyo.exp(-m.z[(l, n)])))
 
-        m.z = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.a = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.c = pyo.ConstraintList()
-
-        for n in m.nodes[1]:
-            m.c.add(m.z[(1, n)] == sum(W[0][n, k] * (m.inputs[k] - self.data.x_train_mean[k]) / self.data.x_train_std[k]
-                                       for k in m.nodes[0]) + b[0][n])
-            m.c.add(m.a[(1, n)] == 1 / (1 + pyo.exp(-m.z[(1, n)])))
-
-        for l in m.layers[2:]:
-            for n in m.nodes[l]:
-                m.c.add(m.z[(l, n)] == sum(W[l - 1][n, k] * m.a[(l - 1, k)] for k in m.nodes[l - 1]) + b[l - 1][n])
-                m.c.add(m.a[(l, n)] == 1 / (1 + pyo.exp(-m.z[(l, n)])))
-
-        for n in m.nodes[last]:
-            m.c.add(m.outputs[n] == m.z[(last, n)] * self.data.y_train_std[n] + self.data.y_train_mean[n])
-        # # retrieve general  model
-        # m. = pyo.Block(rule=self.__general)
-        #
-        # # declare variables
-        # m.inputs = pyo.Var(m..nodes[0])
-        # m.outputs = pyo.Var(m..nodes[len(self.model.layers) - 1])
-        #
-        # # constraints
-        # m.c = pyo.ConstraintList()
-        #
-        # # activated layers return sigmoid of linear outputs
-        # for l in m..layers[1:]:
-        #     for n in m..nodes[l]:
-        #         m.c.add(m..a[(l, n)] == 1 / (1 + pyo.exp(-m..z[(l, n)])))
-        #
-        # # coect inputs to general model
-        # for i in m..nodes[0]:
-        #     m.c.add(m.inputs[i] == m..inputs[i])
-        #
-        # # coect outputs to general model
-        # for i in m..nodes[len(self.model.layers) - 1]:
-        #     m.c.add(m.outputs[i] == m..outputs[i])
+        self._nn_general(m, activation, lambda z: 1 / (1 + np.exp(-z)))
 
     def _nn_softplus_rule(self, m):
-        W = self.model.weights
-        b = self.model.biases
-
-        m.layers = list(range(len(self.model.layers)))
-        m.nodes = {layer: set(range(nodes)) for layer, nodes in enumerate(self.model.layers)}
-
-        last = len(m.layers) - 1
-
-        m.inputs = pyo.Var(m.nodes[0])
-        m.outputs = pyo.Var(m.nodes[len(self.model.layers) - 1])
-
-        m.z = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.a = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.c = pyo.ConstraintList()
+        def activation(m, l, n):
+            m.c.add(m.a[(l, n)] == pyo.log(1 + pyo.exp(m.z[(l, n)])))
 
-        for n in m.nodes[1]:
-            m.c.add(m.z[(1, n)] == sum(W[0][n, k] * (m.inputs[k] - self.data.x_train_mean[k]) / self.data.x_train_std[k]
-                                       for k in m.nodes[0]) + b[0][n])
-            m.c.add(m.a[(1, n)] == pyo.log(1 + pyo.exp(m.z[(1, n)])))
-
-        for l in m.layers[2:]:
-            for n in m.nodes[l]:
-                m.c.add(m.z[(l, n)] == sum(W[l - 1][n, k] * m.a[(l - 1, k)] for k in m.nodes[l - 1]) + b[l - 1][n])
-                m.c.add(m.a[(l, n)] == pyo.log(1 + pyo.exp(m.z[(l, n)])))
-
-        for n in m.nodes[last]:
-            m.c.add(m.outputs[n] == m.z[(last, n)] * self.data.y_train_std[n] + self.data.y_train_mean[n])
-        # # retrieve general  model
-        # m. = pyo.Block(rule=self.__general)
-        #
-        # # declare variables
-        # m.inputs = pyo.Var(m..nodes[0])
-        # m.outputs = pyo.Var(m..nodes[len(self.model.layers) - 1])
-        #
-        # # constraints
-        # m.c = pyo.ConstraintList()
-        #
-        # # activated layers return softplus of linear outputs
-        # for l in m..layers[1:]:
-        #     for n in m..nodes[l]:
-        #         m.c.add(m..a[(l, n)] == pyo.log(1 + pyo.exp(m..z[(l, n)])))
-        #
-        # # coect inputs to general model
-        # for i in m..nodes[0]:
-        #     m.c.add(m.inputs[i] == m..inputs[i])
-        #
-        # # coect outputs to general model
-        # for i in m..nodes[len(self.model.layers) - 1]:
-        #     m.c.add(m.outputs[i] == m..outputs[i])
+        self._nn_general(m, activation, lambda z: np.logaddexp(0, z))
 
     def _nn_relu_rule(self, m):
-        W = self.model.weights
-        b = self.model.biases
-
-        m.layers = list(range(len(self.model.layers)))
-        m.nodes = {layer: set(range(nodes)) for layer, nodes in enumerate(self.model.layers)}
-
-        last = len(m.layers) - 1
-
-        m.inputs = pyo.Var(m.nodes[0])
-        m.outputs = pyo.Var(m.nodes[len(self.model.layers) - 1])
-        m.y = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]), domain=pyo.Binary)
-
-        m.z = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.a = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.c = pyo.ConstraintList()
-
-        for n in m.nodes[1]:
-            m.c.add(m.z[(1, n)] == sum(W[0][n, k] * (m.inputs[k] - self.data.x_train_mean[k]) / self.data.x_train_std[k]
-                                       for k in m.nodes[0]) + b[0][n])
-            m.c.add(m.a[(1, n)] >= 0)
-            m.c.add(m.a[(1, n)] >= m.z[(1, n)])
-            m.c.add(m.a[(1, n)] <= 1e6 * m.y[(1, n)])
-            m.c.add(m.a[(1, n)] <= m.z[(1, n)] + 1e6 * (1 - m.y[(1, n)]))
-
-        for l in m.layers[2:]:
-            for n in m.nodes[l]:
-                m.c.add(m.z[(l, n)] == sum(W[l - 1][n, k] * m.a[(l - 1, k)] for k in m.nodes[l - 1]) + b[l - 1][n])
-                m.c.add(m.a[(l, n)] >= 0)
-                m.c.add(m.a[(l, n)] >= m.z[(l, n)])
-                m.c.add(m.a[(l, n)] <= 1e6 * m.y[(l, n)])
-                m.c.add(m.a[(l, n)] <= m.z[(l, n)] + 1e6 * (1 - m.y[(l, n)]))
-
-        for n in m.nodes[last]:
-            m.c.add(m.outputs[n] == m.z[(last, n)] * self.data.y_train_std[n] + self.data.y_train_mean[n])
-        # # retrieve general  model
-        # m. = pyo.Block(rule=self.__general)
-        #
-        # # declare variables
-        # m.inputs = pyo.Var(m..nodes[0])
-        # m.outputs = pyo.Var(m..nodes[len(self.model.layers) - 1])
-        # m.y = pyo.Var(set([(i, j) for i in m..nodes for j in m..nodes[i]]), domain=pyo.Binary)
-        #
-        # # constraints
-        # m.c = pyo.ConstraintList()
-        #
-        # # activated layers return ReLU of linear outputs, big-M formulation
-        # for l in m..layers[1:]:
-        #     for n in m..nodes[l]:
-        #         m.c.add(m..a[(l, n)] >= 0)
-        #         m.c.add(m..a[(l, n)] >= m..z[(l, n)])
-        #         m.c.add(m..a[(l, n)] <= 1e6 * m.y[(l, n)])
-        #         m.c.add(m..a[(l, n)] <= m..z[(l, n)] + 1e6 * (1 - m.y[(l, n)]))
-        #
-        # # coect inputs to general model
-        # for i in m..nodes[0]:
-        #     m.c.add(m.inputs[i] == m..inputs[i])
-        #
-        # # coect outputs to general model
-        # for i in m..nodes[len(self.model.layers) - 1]:
-        #     m.c.add(m.outputs[i] == m..outputs[i])
+        # ReLU of linear outputs, big-M formulation with M from the z bounds of the neuron
+        def activation(m, l, n):
+            z, a, y = m.z[(l, n)], m.a[(l, n)], m.y[(l, n)]
+            m.c.add(a >= 0)
+            m.c.add(a >= z)
+            m.c.add(a <= _big_m(z.ub) * y)
+            m.c.add(a <= z + _big_m(z.lb, -1) * (1 - y))
+
+        def partition(m, l, n):
+            self._relu_partition(m, l, n, None if self.relu == 'hull' else self.partitions)
+
+        if self.relu != 'bigm':
+            m.sigma = pyo.Var(pyo.Any, dense=False)
+        self._nn_general(m, activation if self.relu == 'bigm' else partition, lambda z: np.maximum(z, 0),
+                         binaries={'y': 0}, pieces=[(0, 0), (1, 0)])
+
+    def _relu_partition(self, m, l, n, partitions):
+        '''
+        partition based ReLU formulation of neuron (l, n), the weighted inputs w_k x_k are split into groups sorted by
+        weight and each group sum v_p is disaggregated into an active part sigma_p, nonzero only when y = 1, and an
+        inactive part v_p - sigma_p, nonzero only when y = 0
+        partitions            -       number of groups, one group is big-M and None, one group per input, is the
+                                      convex hull of the neuron over the box of its inputs
+        '''
+        z, a, y = m.z[(l, n)], m.a[(l, n)], m.y[(l, n)]
+        w = self.model.weights[l - 1][n]
+        x_lo, x_hi = m.input_bounds[l]
+
+        # constant inputs, the substituted dead neurons, add to the bias
+        bias = self.model.biases[l - 1][n]
+        index = []
+        for k, x in enumerate(m.layer_inputs[l]):
+            if w[k] == 0:
+                continue
+            if isinstance(x, (int, float)):
+                bias += w[k] * x
+            else:
+                index.append(k)
+        index = np.array(index, dtype=int)
+        index = index[np.argsort(w[index])]
+        groups = [g for g in np.array_split(index, len(index) if partitions is None else partitions) if len(g)]
+
+        sigma = []
+        for p, group in enumerate(groups):
+            v = sum(w[k] * m.layer_inputs[l][k] for k in group)
+            v_lo = np.minimum(w[group] * x_lo[group], w[group] * x_hi[group]).sum()
+            v_hi = np.maximum(w[group] * x_lo[group], w[group] * x_hi[group]).sum()
+            s = m.sigma[(l, n, p)]
+            m.c.add(s >= v_lo * y)
+            m.c.add(s <= v_hi * y)
+            m.c.add(v - s >= v_lo * (1 - y))
+            m.c.add(v - s <= v_hi * (1 - y))
+            sigma.append(s)
+        m.c.add(a == sum(sigma) + bias * y)
+        m.c.add(a >= z)
+        m.c.add(a >= 0)
+
+        # the z bounds can be tighter than the box of the inputs after obbt, their big-M rows keep that strength
+        m.c.add(a <= _big_m(z.ub) * y)
+        m.c.add(a <= z + _big_m(z.lb, -1) * (1 - y))
 
     def _nn_hardsigmoid_rule(self, m):
-
-        W = self.model.weights
-        b = self.model.biases
-
-        m.layers = list(range(len(self.model.layers)))
-        m.nodes = {layer: set(range(nodes)) for layer, nodes in enumerate(self.model.layers)}
-
-        last = len(m.layers) - 1
-
-        m.inputs = pyo.Var(m.nodes[0])
-        m.outputs = pyo.Var(m.nodes[len(self.model.layers) - 1])
-
-        m.z = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.a = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.p = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]), domain=pyo.Binary)
-        m.q = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]), domain=pyo.Binary)
-        m.c = pyo.ConstraintList()
-
-        for n in m.nodes[1]:
-            m.c.add(m.z[(1, n)] == sum(W[0][n, k] * (m.inputs[k] - self.data.x_train_mean[k]) / self.data.x_train_std[k]
-                                       for k in m.nodes[0]) + b[0][n])
-            m.c.add(m.a[(1, n)] <= m.p[(1, n)])
-            m.c.add(
-                m.a[(1, n)] >=
-                m.z[(1, n)] / 6 + 0.5 - 1e6 * (1 - m.p[(1, n)] + m.q[(1, n)])
-            )
-            m.c.add(
-                m.a[(1, n)] <=
-                m.z[(1, n)] / 6 + 0.5 + 1e6 * (1 - m.p[(1, n)] + m.q[(1, n)])
-            )
-            m.c.add(m.a[(1, n)] >= m.q[(1, n)])
-            m.c.add(m.z[(1, n)] - 1e6 * m.p[(1, n)] <= -3)
-            m.c.add(m.z[(1, n)] + 1e6 * (1 - m.p[(1, n)]) >= -3)
-            m.c.add(m.z[(1, n)] - 1e6 * m.q[(1, n)] <= 3)
-            m.c.add(m.z[(1, n)] + 1e6 * (1 - m.q[(1, n)]) >= 3)
-
-        for l in m.layers[2:]:
-            for n in m.nodes[l]:
-                m.c.add(m.z[(l, n)] == sum(W[l - 1][n, k] * m.a[(l - 1, k)] for k in m.nodes[l - 1]) + b[l - 1][n])
-                m.c.add(m.a[(l, n)] <= m.p[(l, n)])
-                m.c.add(
-                    m.a[(l, n)] >=
-                    m.z[(l, n)] / 6 + 0.5 - 1e6 * (1 - m.p[(l, n)] + m.q[(l, n)])
-                )
-                m.c.add(
-                    m.a[(l, n)] <=
-                    m.z[(l, n)] / 6 + 0.5 + 1e6 * (1 - m.p[(l, n)] + m.q[(l, n)])
-                )
-                m.c.add(m.a[(l, n)] >= m.q[(l, n)])
-                m.c.add(m.z[(l, n)] - 1e6 * m.p[(l, n)] <= -3)
-                m.c.add(m.z[(l, n)] + 1e6 * (1 - m.p[(l, n)]) >= -3)
-                m.c.add(m.z[(l, n)] - 1e6 * m.q[(l, n)] <= 3)
-                m.c.add(m.z[(l, n)] + 1e6 * (1 - m.q[(l, n)]) >= 3)
-
-        for n in m.nodes[last]:
-            m.c.add(m.outputs[n] == m.z[(last, n)] * self.data.y_train_std[n] + self.data.y_train_mean[n])
-
-        # # retrieve general  model
-        # m. = pyo.Block(rule=self.__general)
-        #
-        # # declare variables
-        # m.inputs = pyo.Var(m..nodes[0])
-        # m.outputs = pyo.Var(m..nodes[len(self.model.layers) - 1])
-        # m.p = pyo.Var(set([(i, j) for i in m..nodes for j in m..nodes[i]]), domain=pyo.Binary)
-        # m.q = pyo.Var(set([(i, j) for i in m..nodes for j in m..nodes[i]]), domain=pyo.Binary)
-        #
-        # # constraints
-        # m.c = pyo.ConstraintList()
-        #
-        # # activated layers return HardSigmoid of linear outputs, big-M formulation
-        # for l in m..layers[1:]:
-        #     for n in m..nodes[l]:
-        #         m.c.add(m.nn.a[(l, n)] <= m.p[(l, n)])
-        #         m.c.add(
-        #             m.nn.a[(l, n)] >=
-        #             m.nn.z[(l, n)] / 6 + 0.5 - 1e6 * (1 - m.p[(l, n)] + m.q[(l, n)])
-        #         )
-        #         m.c.add(
-        #             m.nn.a[(l, n)] <=
-        #             m.nn.z[(l, n)] / 6 + 0.5 + 1e6 * (1 - m.p[(l, n)] + m.q[(l, n)])
-        #         )
-        #         m.c.add(m.nn.a[(l, n)] >= m.q[(l, n)])
-        #         m.c.add(m.nn.z[(l, n)] - 1e6 * m.p[(l, n)] <= -3)
-        #         m.c.add(m.nn.z[(l, n)] + 1e6 * (1 - m.p[(l, n)]) >= -3)
-        #         m.c.add(m.nn.z[(l, n)] - 1e6 * m.q[(l, n)] <= 3)
-        #         m.c.add(m.nn.z[(l, n)] + 1e6 * (1 - m.q[(l, n)]) >= 3)
-        #
-        # # coect inputs to general model
-        # for i in m..nodes[0]:
-        #     m.c.add(m.inputs[i] == m..inputs[i])
-        #
-        # # coect outputs to general model
-        # for i in m..nodes[len(self.model.layers) - 1]:
-        #     m.c.add(m.outputs[i] == m..outputs[i])
+        # HardSigmoid of linear outputs, big-M formulation with M from the z bounds of the neuron, p and q mark
+        # z >= -3 and z >= 3 and are constants when the bounds do not straddle their breakpoint
+        def activation(m, l, n):
+            z, a = m.z[(l, n)], m.a[(l, n)]
+            p = m.p[(l, n)] if (l, n) in m.p else 1
+            q = m.q[(l, n)] if (l, n) in m.q else 0
+            big_m = max(_big_m(z.lb, -1 / 6, 0.5), _big_m(z.ub, 1 / 6, 0.5))
+            if (l, n) in m.p:
+                m.c.add(a <= p)
+                m.c.add(z - _big_m(z.ub, 1, 3) * p <= -3)
+                m.c.add(z + _big_m(z.lb, -1, -3) * (1 - p) >= -3)
+            if (l, n) in m.q:
+                m.c.add(a >= q)
+                m.c.add(z - _big_m(z.ub, 1, -3) * q <= 3)
+                m.c.add(z + _big_m(z.lb, -1, 3) * (1 - q) >= 3)
+            m.c.add(a >= z / 6 + 0.5 - big_m * (1 - p + q))
+            m.c.add(a <= z / 6 + 0.5 + big_m * (1 - p + q))
+
+        self._nn_general(m, activation, lambda z: np.clip(z / 6 + 0.5, 0, 1), binaries={'p': -3, 'q': 3},
+                         pieces=[(0, 0), (1 / 6, 0.5), (0, 1)])
 
     def _nn_leakyrelu_rule(self, m):
-        W = self.model.weights
-        b = self.model.biases
-
-        m.layers = list(range(len(self.model.layers)))
-        m.nodes = {layer: set(range(nodes)) for layer, nodes in enumerate(self.model.layers)}
-
-        last = len(m.layers) - 1
+        # LeakyReLU of linear outputs, big-M formulation with M from the z bounds of the neuron
+        def activation(m, l, n):
+            z, a, y = m.z[(l, n)], m.a[(l, n)], m.y[(l, n)]
+            m.c.add(a >= 1e-2 * z)
+            m.c.add(a >= z)
+            m.c.add(a <= z + _big_m(z.lb, -0.99) * (1 - y))
+            m.c.add(a <= 1e-2 * z + _big_m(z.ub, 0.99) * y)
 
-        m.inputs = pyo.Var(m.nodes[0])
-        m.outputs = pyo.Var(m.nodes[len(self.model.layers) - 1])
-        m.y = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]), domain=pyo.Binary)
-
-        m.z = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.a = pyo.Var(set([(i, j) for i in m.nodes for j in m.nodes[i]]))
-        m.c = pyo.ConstraintList()
-
-        for n in m.nodes[1]:
-            m.c.add(m.z[(1, n)] == sum(W[0][n, k] * (m.inputs[k] - self.data.x_train_mean[k]) / self.data.x_train_std[k]
-                                       for k in m.nodes[0]) + b[0][n])
-            m.c.add(m.a[(1, n)] >= 1e-2 * m.z[(1, n)])
-            m.c.add(m.a[(1, n)] >= m.z[(1, n)])
-            m.c.add(m.a[(1, n)] <= m.z[(1, n)] + 1e6 * (1 - m.y[(1, n)]))
-            m.c.add(m.a[(1, n)] <= 1e-2 * m.z[(1, n)] + 1e6 * m.y[(1, n)])
-
-        for l in m.layers[2:]:
-            for n in m.nodes[l]:
-                m.c.add(m.z[(l, n)] == sum(W[l - 1][n, k] * m.a[(l - 1, k)] for k in m.nodes[l - 1]) + b[l - 1][n])
-                m.c.add(m.a[(l, n)] >= 1e-2 * m.z[(l, n)])
-                m.c.add(m.a[(l, n)] >= m.z[(l, n)])
-                m.c.add(m.a[(l, n)] <= m.z[(l, n)] + 1e6 * (1 - m.y[(l, n)]))
-                m.c.add(m.a[(l, n)] <= 1e-2 * m.z[(l, n)] + 1e6 * m.y[(l, n)])
-
-        for n in m.nodes[last]:
-            m.c.add(m.outputs[n] == m.z[(last, n)] * self.data.y_train_std[n] + self.data.y_train_mean[n])
+        self._nn_general(m, activation, lambda z: np.where(z > 0, z, 1e-2 * z), binaries={'y': 0},
+                         pieces=[(1e-2, 0), (1, 0)])
 
     def _hybrid_rule(self, m):
 
@@ -935,11 +789,15 @@ class OODXBlock:
             m.nn = pyo.Block(rule=self._nn_hardsigmoid_rule)
         elif self.model.activation == 'linear':
             m.nn = pyo.Block(rule=self._nn_linear_rule)
-        elif self.model.activation == 'leakyrelu':
+        elif self.model.activation in ('leakyrelu', 'leaky relu'):
             m.nn = pyo.Block(rule=self._nn_leakyrelu_rule)
 
+        # the inputs are scaled inside the feature extractor
         m.inputs = pyo.Var(m.nn.nodes[0])
         m.outputs = pyo.Var(set(range(1)))
+        m.outputs_scaled = pyo.Var(set(range(1)))
+        y_mean, y_std = self._moments(len(m.nn.nodes[0]), 1)[2:]
+        m.scale_outputs = pyo.Constraint(expr=m.outputs[0] == m.outputs_scaled[0] * y_std[0] + y_mean[0])
         m.feature_extractor = pyo.Var(m.nn.nodes[len(self.model.layers) - 1])
         m.c = pyo.ConstraintList()
         for i in m.nn.nodes[0]:
@@ -949,21 +807,34 @@ class OODXBlock:
             m.c.add(m.feature_extractor[i] == m.nn.z[(len(self.model.layers) - 1, i)])
 
         output_scale = self.model.output_scale
-        alpha = self.model.alpha
-        # features = self.model.features
-        x_train = self.model.x_train.numpy()
+        alpha = np.ravel(self.model.alpha)
+        constant_mean = float(self.model.constant_mean)
+        # the GP is trained on the extracted features of the training inputs
+        x_train = self.model.features.numpy()
         n_samples = set(range(x_train.shape[0]))
         n_inputs = set(range(x_train.shape[1]))
         prediction = None
         if self.model.kernel == 'rbf':
             length_scale = self.model.length_scale
-            prediction = sum(alpha[i] * output_scale * pyo.exp(
+            prediction = constant_mean + sum(alpha[i] * output_scale * pyo.exp(
                 -sum(
                     0.5 / length_scale ** 2 * (
                         m.feature_extractor[j] - x_train[i, j]) ** 2 for j in n_inputs)
             ) for i in n_samples)
 
-        prediction = prediction * self.data.y_train_std[0] + self.data.y_train_mean[0]
-
         # gpr constraint
-        m.c.add(m.outputs[0] == prediction)
+        m.c.add(m.outputs_scaled[0] == prediction)
+
+        if self.space is not None:
+            last = len(self.model.layers) - 1
+            lb, ub = np.asarray(self.space, dtype=np.float64).T
+            lo = np.array([m.nn.z[(last, i)].lb for i in n_inputs])
+            hi = np.array([m.nn.z[(last, i)].ub for i in n_inputs])
+            self._set_bounds(m.inputs, lb, ub)
+            self._set_bounds(m.feature_extractor, lo, hi)
+            if self.model.kernel == 'rbf':
+                d2min, d2max = _box_sq_dist(x_train, lo, hi)
+                k_lo = output_scale * np.exp(-0.5 / length_scale ** 2 * d2max)
+                k_hi = output_scale * np.exp(-0.5 / length_scale ** 2 * d2min)
+                self._bound_outputs(m, constant_mean + np.array([np.minimum(alpha * k_lo, alpha * k_hi).sum()]),
+                                    constant_mean + np.array([np.maximum(alpha * k_lo, alpha * k_hi).sum()]))
@@ -1,5 +1,5 @@
 # -- coding: utf-8 --
-from pymoo.core.problem import ElementwiseProblem
+from pymoo.core.problem import Problem
 import numpy as np
 from pymoo.algorithms.moo.nsga2 import NSGA2
 from pymoo.optimize import minimize
@@ -20,7 +20,7 @@ class MyCallback(Callback):
         print(f"Generation: {algorithm.n_gen}, Best F: {best_F}")
 
 
-class MyProblem(ElementwiseProblem):
+class MyProblem(Problem):
 
     def __init__(self, trained_model, n_var, xl, xu, data):
         super().__init__(n_var=n_var, n_obj=1, n_constr=0, xl=xl, xu=xu)
@@ -28,13 +28,12 @@ class MyProblem(ElementwiseProblem):
         self.data = data
 
     def _evaluate(self, x, out, *args, **kwargs):
-        # 将输入变量转化为 GPR 模型可接受的格式
-        x = np.array(x).reshape(1, -1)
-        x = self.data.scale_x(x)
-        # 使用 GPR 模型进行预测
+        # scale the whole population at once
+        x = self.data.scale_x(np.asarray(x).reshape(-1, self.n_var))
+        # predict every individual in a single batched call
         prediction = self.data.inv_scale_y(self.model.predict(x))
-        # 返回预测结果作为目标值
-        out["F"] = - prediction[0, 0]
+        # return the predictions as objective values
+        out["F"] = - prediction[:, 0]
 
 
 class Genetic:
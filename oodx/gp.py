@@ -1,14 +1,84 @@
 import numpy as np
-from numpy.linalg import inv, slogdet
+from numpy.linalg import LinAlgError
+from scipy.linalg import cho_solve, cholesky, solve_triangular
 from scipy.optimize import minimize
+from scipy.spatial.distance import cdist
+from scipy.special import kv, gamma
 from sklearn.gaussian_process import GaussianProcessRegressor, GaussianProcessClassifier
 from sklearn.gaussian_process.kernels import RBF, DotProduct, RationalQuadratic, ExpSineSquared, Matern, Sum, \
     ConstantKernel as con
+from sklearn.utils import check_random_state
+from sklearn.cluster import KMeans
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+import hashlib
+import os
+import threading
 import time
 
 
+class DistanceCache:
+    '''
+    pairwise squared distances to a training set, independent of the kernel hyperparameters
+    x_train               -       training inputs the distances are measured from
+    dtype                 -       storage precision, float32 halves the memory
+    max_bytes             -       largest train-query matrix kept, 0 disables the query cache
+    only the last query is kept, repeated evaluations of one batch reuse it while a stream of new batches such as
+    genetic algorithm populations holds a single matrix
+    '''
+    def __init__(self, x_train, dtype=np.float64, max_bytes=2 ** 28):
+        self.x_train = x_train
+        self.dtype = np.dtype(dtype)
+        self.max_bytes = max_bytes
+        self._train = None
+        self._last = None
+        self._lock = threading.Lock()
+
+    def train(self):
+        ''' (n_train, n_train) distances, kept for the lifetime of the cache '''
+        if self._train is None:
+            self._train = self._compute(self.x_train)
+        return self._train
+
+    def query(self, x):
+        ''' (n_train, n_points) distances to x, looked up by the content of x '''
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        key = (x.shape, hashlib.blake2b(x.tobytes(), digest_size=16).digest())
+        with self._lock:
+            if self._last is not None and self._last[0] == key:
+                return self._last[1]
+        d = self._compute(x)
+        with self._lock:
+            # a new query replaces the last one whether or not it fits the budget
+            self._last = (key, d) if d.nbytes <= self.max_bytes else None
+        return d
+
+    def clear(self):
+        with self._lock:
+            self._last = None
+
+    def _compute(self, x):
+        d = cdist(self.x_train, x, 'sqeuclidean').astype(self.dtype, copy=False)
+        # shared between callers, so read-only
+        d.flags.writeable = False
+        return d
+
+
 class GPR(GaussianProcessRegressor):
-    def __init__(self, kernel='rbf', noise=1e-10, porder=2, n_restarts_optimizer=300):
+    '''
+    kernel                -       kernel name: rbf, linear, polynomial, RationalQuadratic, ExpSineSquared, Matern,
+                                  Sum_RBF, Sum_RQ
+    noise                 -       noise added to the kernel diagonal
+    porder                -       order of the polynomial kernel
+    n_restarts_optimizer  -       hyperparameter restarts from random initial values, the evaluation budget
+    n_jobs                -       worker processes running restarts, -1 uses every core
+    max_time              -       wall-clock budget in seconds for the restarts
+    patience              -       stop after this many restarts without a log-marginal-likelihood gain above tol
+    tol                   -       smallest log-marginal-likelihood gain counted as an improvement
+    cache_dtype           -       storage precision of the cached training distances, float64 or float32
+    cache_bytes           -       largest cached train-query distance matrix, 0 disables the query cache
+    '''
+    def __init__(self, kernel='rbf', noise=1e-10, porder=2, n_restarts_optimizer=300, n_jobs=1, max_time=None,
+                 patience=None, tol=1e-4, cache_dtype=np.float64, cache_bytes=2 ** 28):
         self.name = 'GPR'
         self.kernel_name = kernel
         self.noise = noise
@@ -17,13 +87,24 @@ class GPR(GaussianProcessRegressor):
         self.length_scale_1 = None
         self.constant_value = None
         self.sigma_0 = None
-        self.inv_K = None
+        self._inv_K = None
         self.porder = porder
         self.time = None
         self.scale_mixture = None
         self.scale_mixture_1 = None
         self.periodicity = None
         self.nu = None
+        self.n_jobs = n_jobs
+        self.max_time = max_time
+        self.patience = patience
+        self.tol = tol
+        # wall-clock time of every hyperparameter restart that was run
+        self.restart_times = []
+        # incremental updates since the last full fit
+        self.n_updates = 0
+        self.cache_dtype = cache_dtype
+        self.cache_bytes = cache_bytes
+        self._dist = None
         super().__init__(kernel=self._kernel(kernel), alpha=noise, n_restarts_optimizer=n_restarts_optimizer)
 
     def _kernel(self, kernel):
@@ -49,14 +130,72 @@ class GPR(GaussianProcessRegressor):
 
     def fit(self, x, y, iprint=False):
         self.x_train = x
+        self.n_updates = 0
+        # _save_params replaces alpha with the dual coefficients, restore the noise for sklearn
+        self.alpha = self.noise
         with np.errstate(divide='ignore'):
             start_time = time.time()
-            super().fit(x, y)
+            if self.optimizer is None or self.kernel.n_dims == 0:
+                self.restart_times = []
+                super().fit(x, y)
+            else:
+                # restarts run in our own engine, sklearn then only factorises at the best hyperparameters
+                theta = self._optimise_restarts(x, y)
+                kernel, optimizer = self.kernel, self.optimizer
+                self.kernel, self.optimizer = kernel.clone_with_theta(theta), None
+                try:
+                    super().fit(x, y)
+                finally:
+                    self.kernel, self.optimizer = kernel, optimizer
             end_time = time.time()
         self._save_params()
         self.time = end_time - start_time
         if iprint:
             print('{} model fitted! Time elapsed {:.5f} s'.format(self.name, end_time - start_time))
+            print('{} restarts, mean {:.5f} s each'.format(len(self.restart_times), np.mean(self.restart_times)))
+
+    def _optimise_restarts(self, x, y):
+        # the first start is the kernel's own theta, the rest are drawn log-uniformly within the bounds as in sklearn
+        rng = check_random_state(self.random_state)
+        bounds = self.kernel.bounds
+        n_starts = 1 + self.n_restarts_optimizer
+        starts = (self.kernel.theta if i == 0 else rng.uniform(bounds[:, 0], bounds[:, 1]) for i in range(n_starts))
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        self.restart_times = []
+        best = {'theta': self.kernel.theta, 'lml': -np.inf, 'stall': 0}
+        start_time = time.time()
+
+        def record(result):
+            # returns True once the patience or the time budget is exhausted
+            theta, lml, elapsed = result
+            self.restart_times.append(elapsed)
+            if np.isfinite(lml) and lml > best['lml'] + self.tol:
+                best['stall'] = 0
+            else:
+                best['stall'] += 1
+            if np.isfinite(lml) and lml > best['lml']:
+                best['theta'], best['lml'] = theta, lml
+            return (self.patience is not None and best['stall'] >= self.patience) or \
+                (self.max_time is not None and time.time() - start_time >= self.max_time)
+
+        if n_jobs == 1:
+            gp = _restart_model(self.kernel, self.noise, x, y)
+            for theta in starts:
+                if record(_restart(gp, theta)):
+                    break
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_restart_worker,
+                                     initargs=(self.kernel, self.noise, x, y)) as pool:
+                pending = {pool.submit(_restart_worker, theta) for _, theta in zip(range(n_jobs), starts)}
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    if any([record(future.result()) for future in done]):
+                        for future in pending:
+                            future.cancel()
+                        break
+                    # keep every worker busy until the starts run out
+                    pending |= {pool.submit(_restart_worker, theta) for _, theta in zip(done, starts)}
+        return best['theta']
 
     def _save_params(self):
         params = self.kernel_.get_params()
@@ -85,173 +224,576 @@ class GPR(GaussianProcessRegressor):
             self.length_scale_1 = params['k2__k2__length_scale']
             self.scale_mixture_1 = params['k2__k2__alpha']
         self.alpha = self.alpha_.ravel()
-        K = self.kernel_(self.x_train, self.x_train) + np.eye(self.x_train.shape[0]) * self.noise
-        self.inv_K = inv(K)
+        # the lower Cholesky factor L_ of K + noise * I held by sklearn is the only cached factorisation
+        self._inv_K = None
 
-    def predict(self, x, return_std=False, return_cov=False):
-        if return_std:
-            return super().predict(x, return_std=True)
-        elif return_cov:
-            return super().predict(x, return_cov=True)
-        else:
-            return super().predict(x, return_std=False)
+    @property
+    def inv_K(self):
+        ''' dense K^-1 from the cached factor, only built on demand for the Pyomo std formulations '''
+        if self._inv_K is None and getattr(self, 'L_', None) is not None:
+            self._inv_K = cho_solve((self.L_, True), np.eye(self.L_.shape[0]))
+        return self._inv_K
 
-    def formulation(self, x, return_std=False):
-        n = self.x_train.shape[0]  # number of training samples
-        m = self.x_train.shape[1]  # number of input dimensions
-        # squared exponential kernel evaluated at training and new inputs
+    def _quad(self, k):
+        # k^T K^-1 k per column of k through one triangular solve, v = L^-1 k
+        v = solve_triangular(self.L_, k, lower=True, check_finite=False)
+        return np.einsum('ij,ij->j', v, v)
 
-        if self.kernel_name == 'rbf':
-            k = self.constant_value * np.exp(
-                -sum(0.5 / self.length_scale ** 2 * (
-                        x[:, j].reshape(1, -1) - self.x_train[:, j].reshape(-1, 1)
-                ) ** 2 for j in range(m))
-            )
-        if self.kernel_name == 'linear':
-            k = self.constant_value * (
-                    self.sigma_0 ** 2 + sum(
-                x[:, j].reshape(1, -1) * self.x_train[:, j].reshape(-1, 1) for j in range(m))
-            )
-        if self.kernel_name == 'polynomial':
-            k = self.constant_value * (
-                    self.sigma_0 ** 2 + sum(
-                x[:, j].reshape(1, -1) * self.x_train[:, j].reshape(-1, 1) for j in range(m))
-            ) ** self.porder
+    def update(self, x_new, y_new, refit_hyperparameters=False, refit_every=None, drift_tol=None):
+        '''
+        x_new                 -       new training inputs
+        y_new                 -       new training outputs
+        refit_hyperparameters -       force a full fit with restarts on the augmented data
+        refit_every           -       also refit on every refit_every-th update since the last fit
+        drift_tol             -       also refit when the mean squared standardised error of the new points,
+                                      predicted before they are added, exceeds drift_tol
+        otherwise the hyperparameters are kept and the Cholesky factor is extended by the new rows
+        '''
+        x_new = np.asarray(x_new, dtype=np.float64).reshape(-1, self.X_train_.shape[1])
+        y_new = np.asarray(y_new, dtype=np.float64).reshape((-1,) + self.y_train_.shape[1:])
+        x = np.vstack([self.X_train_, x_new])
+        y = np.concatenate([self.y_train_, y_new])
+        self.n_updates += 1
+
+        refit = refit_hyperparameters or (refit_every is not None and self.n_updates % refit_every == 0)
+        if not refit and drift_tol is not None:
+            mean, std = self.predict(x_new, return_std=True)
+            z = (y_new - mean) / np.maximum(std, np.sqrt(self.noise))
+            refit = np.mean(z ** 2) > drift_tol
+        if refit:
+            self.fit(x, y)
+            return
+
+        # rank-k extension, L = [[L11, 0], [B^T, L22]] with B = L11^-1 K12 and L22 L22^T = K22 - B^T B
+        n, k = self.L_.shape[0], x_new.shape[0]
+        K12 = self.kernel_(self.X_train_, x_new)
+        K22 = self.kernel_(x_new) + np.eye(k) * self.noise
+        B = solve_triangular(self.L_, K12, lower=True, check_finite=False)
+        try:
+            L22 = cholesky(K22 - B.T @ B, lower=True, check_finite=False)
+        except LinAlgError:
+            # the new points are numerically dependent on the old ones, refactorise from scratch
+            self.fit(x, y)
+            return
+        L = np.zeros((n + k, n + k))
+        L[:n, :n] = self.L_
+        L[n:, :n] = B.T
+        L[n:, n:] = L22
+        inv_K = self._inv_K
+        if inv_K is not None:
+            # block inverse from the Schur complement keeps an existing K^-1 current in O(n^2 k)
+            C = inv_K @ K12
+            S_inv = cho_solve((L22, True), np.eye(k))
+            D = C @ S_inv
+            inv_K = np.block([[inv_K + D @ C.T, -D], [-D.T, S_inv]])
+
+        self.X_train_, self.y_train_, self.L_ = x, y, L
+        self.alpha_ = cho_solve((L, True), y, check_finite=False)
+        self.log_marginal_likelihood_value_ = np.sum(
+            -0.5 * np.einsum('i...,i...->...', y, self.alpha_) - np.log(np.diag(L)).sum() - 0.5 * (n + k) * np.log(2 * np.pi))
+        self.x_train = x
+        self._save_params()
+        self._inv_K = inv_K
+
+    def predict(self, x, return_std=False, return_cov=False, chunk_size=None, out=None, out_std=None, n_threads=1):
+        '''
+        x                     -       (n_points, n_inputs) scaled inputs
+        return_std            -       also return the predictive std, only the diagonal of the covariance is formed
+        return_cov            -       return the full predictive covariance instead, not chunked
+        chunk_size            -       points per chunk, by default sized to keep each cross-kernel near 64 MB
+        out, out_std          -       optional preallocated arrays filled with the mean and std
+        n_threads             -       threads the chunks are spread over
+        '''
+        if return_cov:
+            return self._predict_cov(x)
+        x = np.asarray(x)
+        n_outputs = 1 if self.alpha_.ndim == 1 else self.alpha_.shape[1]
+        shape = (x.shape[0],) if n_outputs == 1 else (x.shape[0], n_outputs)
+        if out is None:
+            out = np.empty(shape)
+        if return_std and out_std is None:
+            out_std = np.empty(shape)
+
+        def chunk(s):
+            mean, std = self._predict_chunk(x[s], return_std)
+            out[s] = mean.reshape(out[s].shape)
+            if return_std:
+                out_std[s] = std.reshape(out_std[s].shape)
+
+        _map_chunks(chunk, x.shape[0], chunk_size or _chunk_size(self.x_train.shape[0]), n_threads)
+        return (out, out_std) if return_std else out
+
+    def _predict_cov(self, x):
+        return super().predict(x, return_cov=True)
+
+    def _predict_chunk(self, x, return_std):
+        # mean and std of one chunk from sklearn's fitted kernel, independent of the formulation code it checks,
+        # undoing sklearn's optional target normalisation
+        k = self.kernel_(self.x_train, x)
+        mean = self._y_train_std * (k.T @ self.alpha_) + self._y_train_mean
+        if not return_std:
+            return mean, None
+        std = np.sqrt(np.clip(self.kernel_.diag(x) - self._quad(k), 0, None))
+        return mean, np.outer(std, self._y_train_std)
+
+    def formulation(self, x, return_std=False):
+        '''
+        numpy mirror of the OODXBlock GPR rules on scaled inputs, evaluated for a whole batch of points at once
+        x                     -       (n_points, n_inputs) scaled inputs
+        '''
+        k = self._formulation_kernel(x)
         # linear predictor of mean function
-        pred = sum(k[i] * self.alpha[i] for i in range(n)).reshape(-1, 1)
+        pred = (k.T @ self.alpha).reshape(-1, 1)
         if return_std:
-            # vector-matrix-vector product of k^T K^-1 k
-            vMv = sum(
-                k[i] * sum(
-                    self.inv_K[i, j] * k[j] for j in range(n)
-                ) for i in range(n)
-            )
-            # variance and std at new input
-            if self.kernel_name == 'rbf':
-                k_ss = np.array(self.constant_value).reshape(1, 1)
-            elif self.kernel_name == 'linear':
-                k_ss = self.constant_value * (
-                        self.sigma_0 ** 2 + sum(x[:, j].reshape(1, -1) * x[:, j].reshape(-1, 1) for j in range(m))
-                )
-            elif self.kernel_name == 'polynomial':
-                k_ss = self.constant_value * (
-                        self.sigma_0 ** 2 + sum(x[:, j].reshape(1, -1) * x[:, j].reshape(-1, 1) for j in range(m))
-                ) ** self.porder
-            var = np.diag(k_ss) - vMv
-            std = np.sqrt(var)
+            # variance and std at new input from the vector-matrix-vector product k^T K^-1 k, clipped at zero as in
+            # predict
+            var = self._formulation_kernel_diag(x) - self._quad(k)
+            std = np.sqrt(np.clip(var, 0, None))
             return pred, std
         else:
             return pred
 
+    def _formulation_kernel(self, x):
+        # (n_train, n_points) kernel matrix from the saved hyperparameters
+        if self.kernel_name in ('linear', 'polynomial'):
+            k = self.sigma_0 ** 2 + self.x_train @ x.T
+            return self.constant_value * (k if self.kernel_name == 'linear' else k ** self.porder)
+        # float32 storage is widened for the arithmetic, float64 is used as is
+        sq_dist = np.asarray(self._distances().query(x), dtype=np.float64)
+        if self.kernel_name == 'rbf':
+            return self.constant_value * np.exp(-0.5 / self.length_scale ** 2 * sq_dist)
+        elif self.kernel_name == 'RationalQuadratic':
+            return self.constant_value * _rq(sq_dist, self.length_scale, self.scale_mixture)
+        elif self.kernel_name == 'ExpSineSquared':
+            return self.constant_value * np.exp(
+                -2 * (np.sin(np.pi / self.periodicity * np.sqrt(sq_dist)) / self.length_scale) ** 2)
+        elif self.kernel_name == 'Matern':
+            return self.constant_value * _matern(np.sqrt(sq_dist), self.length_scale, self.nu)
+        elif self.kernel_name == 'Sum_RBF':
+            return self.constant_value * (np.exp(-0.5 / self.length_scale ** 2 * sq_dist) +
+                                          np.exp(-0.5 / self.length_scale_1 ** 2 * sq_dist))
+        elif self.kernel_name == 'Sum_RQ':
+            return self.constant_value * (_rq(sq_dist, self.length_scale, self.scale_mixture) +
+                                          _rq(sq_dist, self.length_scale_1, self.scale_mixture_1))
+        raise ValueError('unknown kernel {}'.format(self.kernel_name))
+
+    def _distances(self):
+        # the cache follows x_train through fit and update
+        if self._dist is None or self._dist.x_train is not self.x_train:
+            self._dist = DistanceCache(self.x_train, dtype=self.cache_dtype, max_bytes=self.cache_bytes)
+        return self._dist
+
+    def _formulation_kernel_diag(self, x):
+        # k(x, x) per point, constant for every stationary kernel
+        if self.kernel_name in ('linear', 'polynomial'):
+            k = self.sigma_0 ** 2 + np.einsum('ij,ij->i', x, x)
+            return self.constant_value * (k if self.kernel_name == 'linear' else k ** self.porder)
+        n_terms = 2 if self.kernel_name in ('Sum_RBF', 'Sum_RQ') else 1
+        return np.full(x.shape[0], n_terms * self.constant_value)
+
+
+class SparseGPR(GPR):
+    '''
+    GPR through m inducing points, so that predictions and the OODXBlock formulations grow with m rather than n
+    n_inducing            -       number of inducing points m
+    inducing              -       inducing point selection: kmeans, random, or an (m, n_inputs) array
+    approximation         -       vfe (variational free energy) or fitc (fully independent training conditional)
+    n_fit                 -       size of the random subset the hyperparameters are fitted on with the exact GPR
+    jitter                -       relative jitter added to the diagonal of K_uu
+    remaining arguments as in GPR
+    '''
+    def __init__(self, kernel='rbf', n_inducing=50, inducing='kmeans', approximation='vfe', n_fit=500, jitter=1e-8,
+                 noise=1e-6, porder=2, n_restarts_optimizer=300, n_jobs=1, max_time=None, patience=None, tol=1e-4,
+                 cache_dtype=np.float64, cache_bytes=2 ** 28):
+        super().__init__(kernel=kernel, noise=noise, porder=porder, n_restarts_optimizer=n_restarts_optimizer,
+                         n_jobs=n_jobs, max_time=max_time, patience=patience, tol=tol, cache_dtype=cache_dtype,
+                         cache_bytes=cache_bytes)
+        self.name = 'SparseGPR'
+        self.n_inducing = n_inducing
+        self.inducing = inducing
+        self.approximation = approximation
+        self.n_fit = n_fit
+        self.jitter = jitter
+        self.x_data = None
+        self.y_data = None
+        self._L_uu = None
+        self._L_B = None
+
+    def fit(self, x, y, iprint=False):
+        start_time = time.time()
+        rng = check_random_state(self.random_state)
+        n = x.shape[0]
+        # hyperparameters from an exact GPR on a subset, the sparse posterior then uses every sample
+        subset = rng.choice(n, self.n_fit, replace=False) if n > self.n_fit else np.arange(n)
+        super().fit(x[subset], y[subset])
+        self.x_data, self.y_data = x, y
+        self.x_train = self._inducing_points(x, rng)
+        self._sparse_posterior()
+        self.time = time.time() - start_time
+        if iprint:
+            print('{} model fitted with {} inducing points! Time elapsed {:.5f} s'.format(
+                self.name, self.x_train.shape[0], self.time))
+
+    def _inducing_points(self, x, rng):
+        if not isinstance(self.inducing, str):
+            return np.asarray(self.inducing, dtype=np.float64)
+        m = min(self.n_inducing, x.shape[0])
+        if self.inducing == 'kmeans':
+            return KMeans(n_clusters=m, n_init=1, random_state=rng.randint(2 ** 31 - 1)).fit(x).cluster_centers_
+        return x[rng.choice(x.shape[0], m, replace=False)]
+
+    def _sparse_posterior(self):
+        # Sigma = (K_uu + K_uf L^-1 K_fu)^-1 with L = noise * I (vfe) or diag(K_ff - Q_ff) + noise * I (fitc),
+        # held as L_uu and the factor L_B of B = I + A A^T where A = L_uu^-1 K_uf L^-1/2
+        z, x, y = self.x_train, self.x_data, self.y_data
+        K_uu = self.kernel_(z)
+        K_uu[np.diag_indices_from(K_uu)] += self.jitter * np.mean(np.diag(K_uu))
+        self._L_uu = cholesky(K_uu, lower=True, check_finite=False)
+        V = solve_triangular(self._L_uu, self.kernel_(z, x), lower=True, check_finite=False)
+        lam = np.full(x.shape[0], self.noise)
+        if self.approximation == 'fitc':
+            lam += np.clip(self.kernel_.diag(x) - np.einsum('ij,ij->j', V, V), 0, None)
+        A = V / np.sqrt(lam)
+        B = A @ A.T
+        B[np.diag_indices_from(B)] += 1
+        self._L_B = cholesky(B, lower=True, check_finite=False)
+        # alpha = Sigma K_uf L^-1 y, so that the mean is k_u(x)^T alpha as for the exact GPR
+        c = cho_solve((self._L_B, True), A @ (y / np.sqrt(lam).reshape((-1,) + (1,) * (y.ndim - 1))),
+                      check_finite=False)
+        self.alpha = solve_triangular(self._L_uu.T, c, lower=False, check_finite=False).ravel()
+        self._inv_K = None
+
+    @property
+    def inv_K(self):
+        ''' K_uu^-1 - Sigma, the matrix in the predictive variance k** - k_u^T (K_uu^-1 - Sigma) k_u '''
+        if self._inv_K is None and self._L_uu is not None:
+            L = solve_triangular(self._L_uu, np.eye(self._L_uu.shape[0]), lower=True, check_finite=False)
+            W = solve_triangular(self._L_B, L, lower=True, check_finite=False)
+            self._inv_K = L.T @ L - W.T @ W
+        return self._inv_K
+
+    def _quad(self, k):
+        v = solve_triangular(self._L_uu, k, lower=True, check_finite=False)
+        w = solve_triangular(self._L_B, v, lower=True, check_finite=False)
+        return np.einsum('ij,ij->j', v, v) - np.einsum('ij,ij->j', w, w)
+
+    def update(self, x_new, y_new, refit_hyperparameters=False, refit_every=None, drift_tol=None):
+        ''' appends the new samples and recomputes the sparse posterior at the current hyperparameters '''
+        x = np.vstack([self.x_data, np.asarray(x_new, dtype=np.float64).reshape(-1, self.x_data.shape[1])])
+        y = np.concatenate([self.y_data, np.asarray(y_new, dtype=np.float64).reshape((-1,) + self.y_data.shape[1:])])
+        self.n_updates += 1
+        refit = refit_hyperparameters or (refit_every is not None and self.n_updates % refit_every == 0)
+        if not refit and drift_tol is not None:
+            mean, std = self.predict(x[self.x_data.shape[0]:], return_std=True)
+            z = (y[self.x_data.shape[0]:] - mean) / np.maximum(std, np.sqrt(self.noise))
+            refit = np.mean(z ** 2) > drift_tol
+        if refit:
+            self.fit(x, y)
+        else:
+            self.x_data, self.y_data = x, y
+            self._sparse_posterior()
+
+    def _predict_chunk(self, x, return_std):
+        k = self.kernel_(self.x_train, x)
+        mean = k.T @ self.alpha
+        if not return_std:
+            return mean, None
+        return mean, np.sqrt(np.clip(self.kernel_.diag(x) - self._quad(k), 0, None))
+
+    def _predict_cov(self, x):
+        k = self.kernel_(self.x_train, x)
+        v = solve_triangular(self._L_uu, k, lower=True, check_finite=False)
+        w = solve_triangular(self._L_B, v, lower=True, check_finite=False)
+        return k.T @ self.alpha, self.kernel_(x) - v.T @ v + w.T @ w
+
+
+def _rq(sq_dist, length_scale, scale_mixture):
+    return (1 + sq_dist / (2 * scale_mixture * length_scale ** 2)) ** (-scale_mixture)
+
+
+def _matern(dist, length_scale, nu):
+    factor = np.sqrt(2 * nu) * dist / length_scale
+    if nu == 0.5:
+        return np.exp(-factor)
+    elif nu == 1.5:
+        return (1 + factor) * np.exp(-factor)
+    elif nu == 2.5:
+        return (1 + factor + factor ** 2 / 3) * np.exp(-factor)
+    # general nu through the modified Bessel function, k -> 1 as the distance goes to zero
+    factor = np.where(factor == 0, np.finfo(float).eps, factor)
+    return 2 ** (1 - nu) / gamma(nu) * factor ** nu * kv(nu, factor)
+
+
+def _chunk_size(n_train, max_bytes=2 ** 26):
+    # rows per chunk that keep an (n_train, chunk) float64 cross-kernel within max_bytes
+    return max(1, max_bytes // (8 * max(n_train, 1)))
+
+
+def _map_chunks(fn, n, chunk_size, n_threads=1):
+    # calls fn on consecutive row slices, numpy releases the GIL in the BLAS and ufunc work of each chunk
+    slices = [slice(i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+    n_threads = os.cpu_count() if n_threads == -1 else n_threads
+    if n_threads == 1 or len(slices) <= 1:
+        for s in slices:
+            fn(s)
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(fn, slices))
+
+
+def check_formulation(model, x, return_std=False):
+    '''
+    compares model.formulation with model.predict over a batch of scaled inputs
+    model                 -       fitted GPR, SparseGPR or GPC
+    x                     -       (n_points, n_inputs) scaled inputs
+    return_std            -       also compare the GPR standard deviation
+    returns a dict of the largest absolute and relative errors and the time taken by each evaluation
+    '''
+    start_time = time.time()
+    form = model.formulation(x, return_std=return_std) if model.name != 'GPC' else model.formulation(x)
+    form_time = time.time() - start_time
+    start_time = time.time()
+    pred = model.predict(x, return_std=return_std) if model.name != 'GPC' else model.predict(x)
+    pred_time = time.time() - start_time
+    if not return_std or model.name == 'GPC':
+        form, pred = (form,), (pred,)
+    report = {'n_points': x.shape[0], 'formulation_time': form_time, 'predict_time': pred_time}
+    for name, f, p in zip(('mean', 'std'), form, pred):
+        f, p = np.ravel(f), np.ravel(p)
+        err = np.abs(f - p)
+        report[name + '_max_abs_error'] = np.max(err)
+        report[name + '_max_rel_error'] = np.max(err / np.maximum(np.abs(p), np.finfo(float).eps))
+    return report
+
+
+def _restart_model(kernel, noise, x, y):
+    # an unoptimised sklearn model only serves to evaluate the log-marginal likelihood and its gradient
+    gp = GaussianProcessRegressor(kernel=kernel, alpha=noise, optimizer=None)
+    try:
+        with np.errstate(divide='ignore'):
+            gp.fit(x, y)
+    except LinAlgError:
+        # the training data and kernel_ are stored before K is factorised
+        pass
+    return gp
+
+
+def _restart(gp, theta):
+    # one L-BFGS-B run from theta, returns the optimum, its log-marginal likelihood and the time taken
+    start_time = time.time()
+
+    def obj_func(theta):
+        lml, grad = gp.log_marginal_likelihood(theta, eval_gradient=True, clone_kernel=False)
+        return -lml, -grad
+
+    with np.errstate(divide='ignore'):
+        result = minimize(obj_func, theta, method='L-BFGS-B', jac=True, bounds=gp.kernel_.bounds)
+    return result.x, -result.fun, time.time() - start_time
+
+
+_restart_gp = None
+
+
+def _init_restart_worker(kernel, noise, x, y):
+    # training data is shipped once per worker process rather than with every restart
+    global _restart_gp
+    _restart_gp = _restart_model(kernel, noise, x, y)
+
+
+def _restart_worker(theta):
+    return _restart(_restart_gp, theta)
+
 
 class GPC:
-    def __init__(self):
+    '''
+    n_restarts            -       extra hyperparameter optimisations from random log-uniform initial values
+    random_state          -       seed for the restart initial values
+    cache_dtype           -       storage precision of the cached training distances, float64 or float32
+    cache_bytes           -       largest cached train-query distance matrix, 0 disables the query cache
+    '''
+    def __init__(self, n_restarts=0, random_state=None, cache_dtype=np.float64, cache_bytes=2 ** 28):
         self.name = 'GPC'
+        self.n_restarts = n_restarts
+        self.random_state = random_state
+        self.cache_dtype = cache_dtype
+        self.cache_bytes = cache_bytes
+        self._dist = None
         self.x_train = None
         self.t_train = None
         self.l = None
         self.sigma_f = None
         self.delta = None
-        self.inv_P = None
         self.time = None
+        # Laplace approximation cached at fit: latent mode f, sqrt(W) and the lower Cholesky factor of
+        # B = I + W^1/2 K W^1/2
+        self.f = None
+        self._sW = None
+        self._L = None
+        self._R = None
+        self._inv_P = None
 
-    def _kernel(self, x1, x2):
-        sq_dist = sum(
-            (x1[:, j].reshape(1, -1) - x2[:, j].reshape(-1, 1)) ** 2 for j in range(x1.shape[1])
-        )
-        sq_exp = self.sigma_f ** 2 * np.exp(- 0.5 / self.l ** 2 * sq_dist)
-        return sq_exp
+    def _kernel(self, sq_dist):
+        # squared exponential kernel on cached squared distances
+        return self.sigma_f ** 2 * np.exp(np.multiply(sq_dist, -0.5 / self.l ** 2, dtype=np.float64))
+
+    def _distances(self):
+        # the cache follows x_train through refits
+        if self._dist is None or self._dist.x_train is not self.x_train:
+            self._dist = DistanceCache(self.x_train, dtype=self.cache_dtype, max_bytes=self.cache_bytes)
+        return self._dist
 
     def fit(self, x, t, iprint=False):
         self.x_train = x
         self.t_train = t
         self._calculate_params(iprint=iprint)
 
-    def predict(self, x, return_std=False, return_class=False, threshold=0.5):
-        a = self._posterior_mode()
-        k_s = self._kernel(x, self.x_train)
-        mu = k_s.T.dot(self.t_train - self._sigmoid(a))
-        var = self.sigma_f ** 2 - k_s.T.dot(self.inv_P).dot(k_s)
-        var = np.diag(var).clip(min=0).reshape(-1, 1)
-        beta = np.sqrt(1 + 3.1416 / 8 * var)
-        prediction = self._sigmoid(mu / beta.ravel())
+    def predict(self, x, return_std=False, return_class=False, threshold=0.5, chunk_size=None, out=None,
+                out_std=None, n_threads=1):
+        '''
+        x                     -       (n_points, n_inputs) scaled inputs
+        return_std            -       also return the std of the latent function
+        return_class          -       also return the class at the given probability threshold
+        chunk_size            -       points per chunk, by default sized to keep each cross-kernel near 64 MB
+        out, out_std          -       optional preallocated (n_points, 1) arrays filled with the probability and std
+        n_threads             -       threads the chunks are spread over
+        '''
+        x = np.asarray(x)
+        if out is None:
+            out = np.empty((x.shape[0], 1))
+        if out_std is None:
+            out_std = np.empty((x.shape[0], 1))
+        delta = np.ravel(self.delta)
+
+        def chunk(s):
+            k_s = self._kernel(self._distances().query(x[s]))
+            # only the diagonal of k_s^T P^-1 k_s is needed for the latent variance
+            var = self.sigma_f ** 2 - self._quad(k_s)
+            var = var.clip(min=0).reshape(-1, 1)
+            out_std[s] = np.sqrt(var)
+            beta = np.sqrt(1 + 3.1416 / 8 * var)
+            out[s] = self._sigmoid((k_s.T @ delta).reshape(-1, 1) / beta)
+
+        _map_chunks(chunk, x.shape[0], chunk_size or _chunk_size(self.x_train.shape[0]), n_threads)
+        prediction, std = out, out_std
         if return_class:
             c = prediction.copy()
             c[c >= threshold] = 1
             c[c < threshold] = 0
             return prediction, c
         elif return_std:
-            return prediction, np.sqrt(var)
+            return prediction, std
         else:
             return prediction
 
     def formulation(self, x):
-        n = self.x_train.shape[0]
-        m = self.x_train.shape[1]
-        sq_exp = np.exp(
-            -sum(0.5 / self.l ** 2 * (
-                    x[:, j].reshape(1, -1) - self.x_train[:, j].reshape(-1, 1)) ** 2 for j in range(m))
-        )
-        mu = self.sigma_f ** 2 * sum(self.delta[i] * sq_exp[i] for i in range(n))
-        var = self.sigma_f ** 2 * (1 - sum(
-            sq_exp[i] * self.sigma_f ** 2 * sum(
-                sq_exp[i_] * self.inv_P[i, i_] for i_ in range(n)) for i in range(n)))
+        ''' numpy mirror of the OODXBlock GPC rule, evaluated for a whole batch of points at once '''
+        sq_exp = np.exp(np.multiply(self._distances().query(x), -0.5 / self.l ** 2, dtype=np.float64))
+        mu = self.sigma_f ** 2 * (sq_exp.T @ np.ravel(self.delta))
+        var = self.sigma_f ** 2 * (1 - self.sigma_f ** 2 * self._quad(sq_exp))
         beta = np.sqrt(1 + 3.1416 / 8 * var)
         prediction = 1 / (1 + np.exp(- mu / beta))
         return prediction.reshape(-1, 1)
 
-    def _posterior_mode(self, max_iter=10, tol=1e-9):
-        K = self._kernel(self.x_train, self.x_train)
-        a = np.zeros_like(self.t_train)
-        I = np.eye(self.x_train.shape[0])
+    @property
+    def inv_P(self):
+        ''' dense P^-1 = (W^-1 + K)^-1 = W^1/2 B^-1 W^1/2, only built on demand for the Pyomo formulation '''
+        if self._inv_P is None and self._L is not None:
+            self._inv_P = self._sW[:, None] * cho_solve((self._L, True), np.diag(self._sW))
+        return self._inv_P
+
+    def _quad(self, k):
+        # k^T P^-1 k per column of k as |v|^2 with v = L^-1 W^1/2 k, the eigenvalues of B are >= 1 so the
+        # triangular inverse R = L^-1 W^1/2 is well conditioned and is formed once to apply it as a matrix product
+        if self._R is None:
+            self._R = solve_triangular(self._L, np.diag(self._sW), lower=True, check_finite=False)
+        v = self._R @ k
+        return np.einsum('ij,ij->j', v, v)
+
+    def _posterior_mode(self, K, f=None, max_iter=100, tol=1e-9):
+        '''
+        Newton iterations for the mode of the Laplace approximation, GPML Algorithm 3.1
+        f                     -       initial latent values, zeros if None
+        returns the mode f, a = K^-1 f, sqrt(W), the lower Cholesky factor of B = I + W^1/2 K W^1/2 and the
+        approximate log marginal likelihood
+        '''
+        t = np.ravel(self.t_train)
+        warm = f is not None
+        f = np.zeros_like(t, dtype=np.float64) if f is None else f
+        psi = -np.inf
+        converged = False
         for i in range(max_iter):
-            W = self._sigmoid(a) * (1 - self._sigmoid(a))
-            W = np.diag(W.ravel())
-            inv_Q = inv(I + W @ K)
-            a_new = (K @ inv_Q).dot(self.t_train - self._sigmoid(a) + W.dot(a))
-            a_diff = np.abs(a_new - a)
-            a = a_new
-            if not np.any(a_diff > tol):
+            pi = self._sigmoid(f)
+            W = pi * (1 - pi)
+            sW = np.sqrt(W)
+            L = cholesky(np.eye(t.shape[0]) + sW[:, None] * K * sW, lower=True, check_finite=False)
+            b = W * f + t - pi
+            a = b - sW * cho_solve((L, True), sW * (K @ b), check_finite=False)
+            f = K @ a
+            psi_new = -0.5 * a @ f + np.sum(t * f - np.logaddexp(0, f))
+            converged = abs(psi_new - psi) < tol
+            psi = psi_new
+            if converged:
                 break
-        return a
+        # a warm start that failed to converge, or ended below the objective at f = 0, is redone from zeros
+        if warm and (not converged or psi < -t.shape[0] * np.log(2)):
+            return self._posterior_mode(K, max_iter=max_iter, tol=tol)
+        # factor at the final mode, used by the likelihood and by predictions
+        pi = self._sigmoid(f)
+        sW = np.sqrt(pi * (1 - pi))
+        L = cholesky(np.eye(t.shape[0]) + sW[:, None] * K * sW, lower=True, check_finite=False)
+        return f, a, sW, L, psi - np.log(np.diag(L)).sum()
 
     def _calculate_params(self, iprint):
         start_time = time.time()
-        params = minimize(
-            fun=self._opt_fun,
-            x0=[1.0, 1.0],
-            bounds=[(1e-6, None), (1e-6, None)],
-            method='L-BFGS-B',
-            options={'iprint': -1})
+        rng = check_random_state(self.random_state)
+        self._f_warm = None
+        # the first start is (1, 1) as before, the rest are drawn log-uniformly
+        starts = [np.ones(2)] + [np.exp(rng.uniform(np.log([1e-2, 1e-1]), np.log([1e2, 1e2])))
+                                 for _ in range(self.n_restarts)]
+        best = None
+        for x0 in starts:
+            params = minimize(
+                fun=self._opt_fun,
+                x0=x0,
+                jac=True,
+                bounds=[(1e-6, None), (1e-6, None)],
+                method='L-BFGS-B',
+                options={'iprint': -1})
+            if best is None or params.fun < best.fun:
+                best = params
         end_time = time.time()
-        self.l = params.x[0]
-        self.sigma_f = params.x[1]
-        a = self._posterior_mode()
-        W = self._sigmoid(a) * (1 - self._sigmoid(a))
-        I = np.eye(self.x_train.shape[0])
-        W = np.diag(W.ravel()) + 1e-5 * I
-        K = self._kernel(self.x_train, self.x_train)
-        P = inv(W) + K
-        self.inv_P = inv(P)
-        self.delta = self.t_train - self._sigmoid(a)
+        self.l = best.x[0]
+        self.sigma_f = best.x[1]
+        K = self._kernel(self._distances().train())
+        self.f, _, self._sW, self._L, _ = self._posterior_mode(K)
+        self._R = self._inv_P = self._f_warm = None
+        self.delta = self.t_train - self._sigmoid(self.f).reshape(np.shape(self.t_train))
         self.time = end_time - start_time
         if iprint:
             print('{} model fitted! Time elapsed {:.5f} s'.format(self.name, end_time - start_time))
 
     def _opt_fun(self, theta):
-        I = np.eye(self.x_train.shape[0])
+        ''' negative Laplace log marginal likelihood and its gradient in (l, sigma_f), GPML Algorithm 5.1 '''
         self.l = theta[0]
         self.sigma_f = theta[1]
-        K = self._kernel(self.x_train, self.x_train) + 1e-5 * I
-        inv_K = inv(K)
-        a = self._posterior_mode()
-        W = self._sigmoid(a) * (1 - self._sigmoid(a))
-        W = np.diag(W.ravel())
-        ll = self.t_train.T.dot(a) - np.sum(np.log(1.0 + np.exp(a))) - 0.5 * (
-                a.T.dot(inv_K).dot(a) +
-                slogdet(K)[1] +
-                slogdet(W + inv_K)[1])
-        return -ll.ravel()
+        t = np.ravel(self.t_train)
+        sq_dist = self._distances().train()
+        K = self._kernel(sq_dist)
+        # the previous mode is a close starting point while the optimiser takes small steps
+        f, a, sW, L, ll = self._posterior_mode(K, f=self._f_warm)
+        self._f_warm = f
+        pi = self._sigmoid(f)
+        R = solve_triangular(L, np.diag(sW), lower=True, check_finite=False)
+        R = R.T @ R
+        C = solve_triangular(L, sW[:, None] * K, lower=True, check_finite=False)
+        # implicit dependence through the mode, dW/df = -d3 log p(t|f)/df3 for the logistic likelihood
+        s2 = -0.5 * (np.diag(K) - np.einsum('ij,ij->j', C, C)) * (pi * (1 - pi) * (1 - 2 * pi))
+        grad = np.empty(2)
+        for j, dK in enumerate((K * sq_dist / self.l ** 3, 2 / self.sigma_f * K)):
+            s1 = 0.5 * a @ dK @ a - 0.5 * np.sum(R * dK)
+            b = dK @ (t - pi)
+            grad[j] = s1 + s2 @ (b - K @ (R @ b))
+        return -ll, -grad
 
     @staticmethod
     def _sigmoid(a):
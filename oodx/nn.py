@@ -1,10 +1,16 @@
 import numpy as np
 import torch
 from torch import nn
+from torch.nn.utils import prune
+import pyomo.environ as pyo
 import time
 
 import matplotlib.pyplot as plt
 
+from .formulations import OODXBlock, formulation_size
+# the numpy forward pass lives in a torch-free module, re-exported here
+from ._forward import forward, _activation
+
 
 class NN(nn.Sequential):
     def __init__(self, layers, activation='tanh', is_classifier=False):
@@ -18,6 +24,10 @@ class NN(nn.Sequential):
         self.weights = []
         self.biases = []
         self.time = 0
+        self.history = None
+        self.epochs_run = 0
+        self.epochs_per_second = None
+        self.fit_params = {}
         super().__init__(*self._build_layers(layers))
 
     def fit(
@@ -30,50 +40,212 @@ class NN(nn.Sequential):
         learning_rate=1e-2, 
         weight_decay=0.0,
         loss_func=nn.MSELoss(), 
-        iprint=False
+        iprint=False,
+        val_split=0.0,
+        patience=None,
+        min_delta=0.0,
+        scheduler=None,
+        optimiser='adam',
+        callback_every=1,
+        seed=None
     ):
+        '''
+        callback              -       function (epoch, loss) called every callback_every epochs and after the last one
+        val_split             -       fraction of the samples held out to monitor the loss
+        patience              -       stop after this many epochs without the monitored loss, the validation loss
+                                      when val_split > 0, improving by min_delta and restore the best weights
+        scheduler             -       None, 'cosine', 'plateau' or a function (optimiser) returning a torch scheduler
+        optimiser             -       'adam' on mini-batches or 'lbfgs', one full-batch strong Wolfe L-BFGS step per
+                                      epoch for small data sets, learning_rate is then not used
+        seed                  -       seed of the validation split and the batch shuffling
+        '''
+        self.fit_params = dict(
+            batch_size=batch_size, learning_rate=learning_rate, weight_decay=weight_decay, loss_func=loss_func,
+            val_split=val_split, patience=patience, min_delta=min_delta, scheduler=scheduler, optimiser=optimiser)
         if self.name == 'NNClf':
             loss_func = nn.BCEWithLogitsLoss()
-        x_train, y_train = torch.Tensor(x), torch.Tensor(y).unsqueeze(1)
-        optimiser = torch.optim.Adam(self.parameters(), lr=learning_rate, weight_decay=weight_decay)
+        x_train = torch.as_tensor(np.asarray(x), dtype=torch.float32)
+        y_train = torch.as_tensor(np.asarray(y), dtype=torch.float32).reshape(-1, 1)
+        generator = torch.Generator().manual_seed(seed) if seed is not None else None
+        x_val = y_val = None
+        if val_split > 0:
+            permutation = torch.randperm(len(x_train), generator=generator)
+            n_val = max(1, int(round(val_split * len(x_train))))
+            x_val, y_val = x_train[permutation[:n_val]], y_train[permutation[:n_val]]
+            x_train, y_train = x_train[permutation[n_val:]], y_train[permutation[n_val:]]
+
+        if optimiser == 'adam':
+            opt = torch.optim.Adam(self.parameters(), lr=learning_rate, weight_decay=weight_decay)
+        elif optimiser == 'lbfgs':
+            opt = torch.optim.LBFGS(self.parameters(), max_iter=20, history_size=20, line_search_fn='strong_wolfe')
+        else:
+            raise ValueError('unknown optimiser {}'.format(optimiser))
+        if scheduler == 'cosine':
+            sched = torch.optim.lr_scheduler.CosineAnnealingLR(opt, T_max=epochs)
+        elif scheduler == 'plateau':
+            sched = torch.optim.lr_scheduler.ReduceLROnPlateau(opt, factor=0.5, patience=10)
+        elif callable(scheduler):
+            sched = scheduler(opt)
+        elif scheduler is None:
+            sched = None
+        else:
+            raise ValueError('unknown scheduler {}'.format(scheduler))
+
+        def closure():
+            # full-batch objective of L-BFGS, with the L2 penalty Adam applies through weight_decay
+            opt.zero_grad()
+            objective = loss_func(self.forward(x_train), y_train)
+            if weight_decay:
+                objective = objective + 0.5 * weight_decay * sum(p.pow(2).sum() for p in self.parameters())
+            objective.backward()
+            return objective
+
         self.train()
         start_time = time.time()
-        train_loss = []
+        train_loss, val_loss = [], []
+        best, best_state, wait = np.inf, None, 0
         for epoch in range(epochs):
-            epoch_loss = 0.0
-            permutation = torch.randperm(len(x_train))
-            for i in range(0, len(x_train), batch_size):
-                idx = permutation[i:i+batch_size]
-                x_batch, y_batch = x_train[idx], y_train[idx]
-                predictions = self.forward(x_batch)
-                loss = loss_func(predictions, y_batch)
-                optimiser.zero_grad()
-                loss.backward()
-                optimiser.step()
-                epoch_loss += loss.item()
-            epoch_loss /= len(x_train)/batch_size
-            if callback:
-                callback(epoch, epoch_loss)
+            if optimiser == 'lbfgs':
+                opt.step(closure)
+                with torch.no_grad():
+                    epoch_loss = loss_func(self.forward(x_train), y_train)
+            else:
+                # losses stay on the device, the host only reads them once per epoch when something needs them
+                epoch_loss = torch.zeros(())
+                permutation = torch.randperm(len(x_train), generator=generator)
+                for x_batch, y_batch in zip(x_train[permutation].split(batch_size),
+                                            y_train[permutation].split(batch_size)):
+                    loss = loss_func(self.forward(x_batch), y_batch)
+                    opt.zero_grad(set_to_none=True)
+                    loss.backward()
+                    opt.step()
+                    epoch_loss += loss.detach() * len(x_batch)
+                epoch_loss /= len(x_train)
             train_loss.append(epoch_loss)
+            monitored = epoch_loss
+            if x_val is not None:
+                with torch.no_grad():
+                    monitored = loss_func(self.forward(x_val), y_val)
+                val_loss.append(monitored)
+
+            if isinstance(sched, torch.optim.lr_scheduler.ReduceLROnPlateau):
+                sched.step(monitored)
+            elif sched is not None:
+                sched.step()
+            stop = False
+            if patience is not None:
+                value = monitored.item()
+                if value < best - min_delta:
+                    best, wait = value, 0
+                    best_state = {key: tensor.clone() for key, tensor in self.state_dict().items()}
+                else:
+                    wait += 1
+                    stop = wait >= patience
+            if callback and ((epoch + 1) % callback_every == 0 or stop or epoch == epochs - 1):
+                callback(epoch, epoch_loss.item())
+            if stop:
+                break
+        if best_state is not None:
+            self.load_state_dict(best_state)
         end_time = time.time()
-        # plt.plot(range(1, epochs + 1), train_loss, label='Training Loss')
-        # plt.xlabel('Epochs')
-        # plt.ylabel('Loss')
-        # plt.title('Training Loss vs. Epochs')
-        # plt.legend()
-        # plt.show()
+        # epochs=0 runs no epoch and only exports the current weights
+        self.history = {'loss': torch.stack(train_loss).tolist() if train_loss else [],
+                        'val_loss': torch.stack(val_loss).tolist() if val_loss else []}
+        self.epochs_run = len(train_loss)
+        self.epochs_per_second = self.epochs_run / max(end_time - start_time, 1e-12)
         self._get_params()
         self.time = end_time - start_time
         if iprint:
-            print('{} model fitted! Time elapsed {:.5f} s'.format(self.name, end_time - start_time))
+            print('{} model fitted! Time elapsed {:.5f} s, {} epochs at {:.1f} epochs/s'.format(
+                self.name, self.time, self.epochs_run, self.epochs_per_second))
+
+    def refit(self, x, y, epochs=100, **kwargs):
+        '''
+        continue training from the current weights, for example on a data set augmented by new samples, with the
+        settings of the last fit (cosine schedule if it had none) unless given in kwargs, a fraction of the epochs of a
+        fit from random weights
+        '''
+        # fine-tuning anneals the learning rate so each step settles rather than ends on a noisy update
+        params = dict(self.fit_params, scheduler=self.fit_params.get('scheduler') or 'cosine')
+        params.update(kwargs)
+        self.fit(x, y, epochs=epochs, **params)
+
+    def prune(self, x, y, sparsity=0.5, tol=0.05, steps=5, epochs=100, x_val=None, y_val=None, space=None, **kwargs):
+        '''
+        iterative global magnitude pruning, each step zeroes the smallest weights of every layer together and fine-tunes
+        the rest with the settings of the last fit (cosine schedule if it had none) unless given in kwargs, the zero
+        weights and the neurons they disconnect are left out of the formulation
+        sparsity              -       target fraction of zero weights
+        tol                   -       largest relative increase of the loss over the unpruned network, pruning stops
+                                      at the last step within it
+        steps                 -       pruning steps towards the target sparsity, each followed by epochs of fine-tuning
+        x_val, y_val          -       data the loss is measured on, x and y when None
+        space                 -       input space of the formulation sizes in the report
+        returns a report of the sparsity, loss, nonzero weights and formulation size before and after
+        '''
+        x_val, y_val = (x, y) if x_val is None else (x_val, y_val)
+        linear = [layer for layer in self if isinstance(layer, nn.Linear)]
+        params = dict(self.fit_params, scheduler=self.fit_params.get('scheduler') or 'cosine')
+        params.update(kwargs)
+        report = {'loss': [self._loss(x_val, y_val)], 'nonzeros': [self._nonzeros()],
+                  'formulation': [self._formulation_size(space)]}
+        limit = report['loss'][0] * (1 + tol)
+
+        n_weights = sum(layer.weight.numel() for layer in linear)
+        state = {key: tensor.clone() for key, tensor in self.state_dict().items()}
+        for step in range(1, steps + 1):
+            # the weights zeroed by earlier steps are the smallest, so the mask of a step covers them again
+            prune.global_unstructured([(layer, 'weight') for layer in linear], pruning_method=prune.L1Unstructured,
+                                      amount=int(round(sparsity * step / steps * n_weights)))
+            self.fit(x, y, epochs=epochs, **params)
+            for layer in linear:
+                prune.remove(layer, 'weight')
+            if self._loss(x_val, y_val) > limit:
+                self.load_state_dict(state)
+                break
+            state = {key: tensor.clone() for key, tensor in self.state_dict().items()}
+        self._get_params()
+
+        report['loss'].append(self._loss(x_val, y_val))
+        report['nonzeros'].append(self._nonzeros())
+        report['formulation'].append(self._formulation_size(space))
+        report['sparsity'] = 1 - report['nonzeros'][1] / n_weights
+        return report
+
+    def _loss(self, x, y):
+        # loss of the fit on x, y
+        loss_func = nn.BCEWithLogitsLoss() if self.name == 'NNClf' else self.fit_params.get('loss_func', nn.MSELoss())
+        self.eval()
+        with torch.no_grad():
+            return loss_func(self.forward(torch.as_tensor(np.asarray(x), dtype=torch.float32)),
+                             torch.as_tensor(np.asarray(y), dtype=torch.float32).reshape(-1, 1)).item()
+
+    def _nonzeros(self):
+        return sum(int(torch.count_nonzero(layer.weight)) for layer in self if isinstance(layer, nn.Linear))
+
+    def _formulation_size(self, space):
+        self._get_params()
+        block = pyo.ConcreteModel()
+        block.b = OODXBlock(self).get_formulation(space=space)
+        return formulation_size(block.b)
 
-    def predict(self, x, return_proba=False, return_class=False, threshold=0.5):
-        x = torch.Tensor(x)
+    def predict(self, x, return_proba=False, return_class=False, threshold=0.5, chunk_size=None):
+        '''
+        x                     -       inputs (n, n_inputs), float32 arrays are used without a copy
+        return_proba          -       also return the sigmoid of the output
+        return_class          -       also return the class, 1 above threshold and the output clipped at 0 otherwise
+        chunk_size            -       rows per forward pass, by default 2**16 activations of the widest layer
+        only the requested outputs are computed
+        '''
+        x = torch.from_numpy(np.ascontiguousarray(np.asarray(x, dtype=np.float32)))
+        if chunk_size is None:
+            chunk_size = max(1, 2 ** 16 // max(self.layers))
         self.eval()
-        y = self.forward(x).detach()
-        c = torch.max(y, torch.tensor([0.]))
-        proba = torch.sigmoid(y).detach()
-        c[proba > threshold] = 1
+        with torch.inference_mode():
+            y = torch.cat([self.forward(x[i:i + chunk_size]) for i in range(0, x.shape[0], chunk_size)]) \
+                if x.dim() > 1 and x.shape[0] > chunk_size else self.forward(x)
+            proba = torch.sigmoid(y) if return_proba or return_class or self.is_classifier else None
+            c = torch.where(proba > threshold, 1., torch.clamp(y, min=0.)) if return_class else None
         if return_class and return_proba:
             return y.numpy(), proba.numpy(), c.numpy()
         elif return_class:
@@ -85,67 +257,21 @@ class NN(nn.Sequential):
         else:
             return y.numpy()
         
-    def formulation(self, x):
-        output = np.zeros((x.shape[0], 1))
+    def formulation(self, x, chunk_size=None):
+        '''
+        numpy forward pass through the exported weights and biases, the function the OODXBlock formulation encodes
+        x                     -       inputs (n, n_inputs)
+        chunk_size            -       rows per batched matrix product, bounded memory for large x
+        '''
+        return forward(x, self.weights, self.biases, self.activation, chunk_size=chunk_size)
 
-        for ind, x_val in enumerate(x):
-
-            w = self.weights
-            b = self.biases
-            af = self._af_selector()
-            n = {i: set(range(w[i].shape[1])) for i in range(len(w))}
-            a = {key: lambda x: af(x) for key in range(len(w) - 1)}
-            a[len(a)] = lambda x: x
-
-            def f(i):
-                if i == -1:
-                    return x_val
-                return a[i](sum(torch.from_numpy(w[i])[:, j] * f(i-1)[j] for j in n[i]) + torch.from_numpy(b[i]))
-
-            output_val = f(len(self.weights) - 1)
-            output[ind] = output_val.numpy()
-
-        return output
-    
     def _get_params(self):
-        for layer in self:
-            if isinstance(layer, nn.Linear):
-                self.weights.append(layer.weight.data.numpy())
-                self.biases.append(layer.bias.data.numpy())
+        # snapshot of the current layers, replaced rather than appended so refitting keeps one entry per layer
+        self.weights = [layer.weight.detach().cpu().numpy().copy() for layer in self if isinstance(layer, nn.Linear)]
+        self.biases = [layer.bias.detach().cpu().numpy().copy() for layer in self if isinstance(layer, nn.Linear)]
     
     def _af_selector(self):
-        if self.activation == 'tanh':
-            def f(x):
-                return 1 - 2 / (np.exp( 2 * x ) + 1)
-        
-        elif self.activation == 'sigmoid':
-            def f(x):
-                return 1 / (1 + np.exp( -x ))
-        elif self.activation == 'softplus':
-            def f(x):
-                return np.log(1 + np.exp(x))
-
-        elif self.activation == 'relu':
-            def f(x):
-                return np.maximum(0, x)
-        
-        elif self.activation == 'linear':
-            def f(x):
-                return x
-
-        elif self.activation == 'hardsigmoid':
-            def f(x):
-                y = np.zeros_like(x)
-                for i in range(len(y)):
-                    if x[i] >= 3:
-                        y[i] = 1
-                    elif x[i] <= -3:
-                        y[i] = 0
-                    else:
-                        y[i] = x[i] / 6 + 0.5
-                return y
-        
-        return f
+        return _activation(self.activation)
 
     def _activation_selector(self):
         if self.activation == 'tanh':
@@ -160,7 +286,7 @@ class NN(nn.Sequential):
             return nn.Hardsigmoid()
         elif self.activation == 'linear':
             return nn.Identity()
-        elif self.activation == 'leaky relu':
+        elif self.activation in ('leakyrelu', 'leaky relu'):
             return nn.LeakyReLU()
 
     def _build_layers(self, layers):
@@ -0,0 +1,247 @@
+import numpy as np
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import qmc
+
+
+# persistent design cache shared between sessions
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'oodx', 'designs')
+
+
+def grid_size(n_samples, n_dims):
+    ''' smallest number of levels per dimension whose full grid holds n_samples points '''
+    n = max(int(round(n_samples ** (1 / n_dims))), 1)
+    while n ** n_dims < n_samples:
+        n += 1
+    return n
+
+
+def iter_samples(space, n_samples=None, method='random', chunk_size=10000, seed=None, shuffle=True, levels=None):
+    '''
+    space             -       input space, list of (lb, ub) per dimension
+    n_samples         -       number of samples, for grid None streams the full grid of the given levels
+    method            -       sampling method: random, lhs, sobol, grid
+    chunk_size        -       maximum number of rows per yielded chunk
+    seed              -       seed or numpy Generator for reproducible designs
+    shuffle           -       grid only, draw n_samples grid points at random instead of in index order
+    levels            -       grid only, points per dimension, by default the fewest that hold n_samples
+    yields (chunk_size, n_dims) arrays, so only one chunk of the design is held in memory at a time
+    '''
+    bounds = np.asarray(space, dtype=np.float64)
+    lb, width = bounds[:, 0], bounds[:, 1] - bounds[:, 0]
+    m = bounds.shape[0]
+    rng = np.random.default_rng(seed)
+
+    if method == 'grid':
+        yield from _iter_grid(bounds, n_samples, chunk_size, rng, shuffle, levels)
+        return
+    if n_samples is None:
+        raise ValueError('n_samples is required for {} sampling'.format(method))
+
+    if method == 'random':
+        for start in range(0, n_samples, chunk_size):
+            k = min(chunk_size, n_samples - start)
+            yield lb + rng.random((k, m)) * width
+
+    elif method == 'lhs':
+        # one keyed stratum permutation per dimension, evaluated for the rows of each chunk so that no
+        # (n_samples, n_dims) array is built, the jitter is drawn per chunk
+        keys = rng.integers(2 ** 63, size=(m, _FEISTEL_ROUNDS), dtype=np.uint64)
+        for start in range(0, n_samples, chunk_size):
+            index = np.arange(start, min(start + chunk_size, n_samples), dtype=np.uint64)
+            rows = np.stack([_permute(index, n_samples, keys[j]) for j in range(m)], axis=1)
+            yield lb + (rows + rng.random(rows.shape)) / n_samples * width
+
+    elif method == 'sobol':
+        sobol = qmc.Sobol(d=m, scramble=True, seed=rng)
+        for start in range(0, n_samples, chunk_size):
+            k = min(chunk_size, n_samples - start)
+            with warnings.catch_warnings():
+                # balance warnings for non powers of 2 do not apply to a streamed prefix
+                warnings.simplefilter('ignore', UserWarning)
+                yield lb + sobol.random(k) * width
+
+    else:
+        raise ValueError('unknown sampling method {}'.format(method))
+
+
+def sample(space, n_samples, method='random', seed=None):
+    ''' whole design as a single array, see iter_samples '''
+    chunks = list(iter_samples(space, n_samples, method=method, chunk_size=max(n_samples, 1), seed=seed))
+    return np.concatenate(chunks) if chunks else np.empty((0, len(space)))
+
+
+class LHS:
+    '''
+    space-filling latin hypercube designs, optimised by swapping elements within a column
+    criterion         -       design criterion: maximin, maximise the smallest pairwise distance
+    iterations        -       swap proposals per chain
+    n_chains          -       independent optimisation chains, the best design is kept
+    n_jobs            -       worker processes running the chains
+    cache_dir         -       directory of the persistent design cache, None disables caching
+    '''
+    def __init__(self, criterion='maximin', iterations=1000, n_chains=1, n_jobs=1, cache_dir=CACHE_DIR):
+        if criterion != 'maximin':
+            raise ValueError('unknown design criterion {}'.format(criterion))
+        self.criterion = criterion
+        self.iterations = iterations
+        self.n_chains = n_chains
+        self.n_jobs = n_jobs
+        self.cache_dir = cache_dir
+
+    def generate(self, space, n_samples, seed=None):
+        bounds = np.asarray(space, dtype=np.float64)
+        return bounds[:, 0] + self.unit(n_samples, bounds.shape[0], seed) * (bounds[:, 1] - bounds[:, 0])
+
+    def unit(self, n_samples, n_dims, seed=None):
+        ''' design on the unit hypercube, reused from the cache when seeded '''
+        path = self._cache_path(n_samples, n_dims, seed)
+        if path is not None and os.path.exists(path):
+            return np.load(path)
+        seeds = np.random.SeedSequence(seed).spawn(self.n_chains)
+        args = [(n_samples, n_dims, self.iterations, s) for s in seeds]
+        if self.n_jobs > 1 and self.n_chains > 1:
+            with ProcessPoolExecutor(max_workers=min(self.n_jobs, self.n_chains)) as pool:
+                chains = list(pool.map(_maximin_chain, *zip(*args)))
+        else:
+            chains = [_maximin_chain(*arg) for arg in args]
+        design = max(chains, key=lambda chain: chain[1])[0]
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write then rename, so concurrent campaigns never read a partial file
+            tmp = '{}.{}.tmp.npy'.format(path[:-4], os.getpid())
+            np.save(tmp, design)
+            os.replace(tmp, path)
+        return design
+
+    def extend(self, x, space, n_new, seed=None, n_candidates=None):
+        '''
+        x                 -       existing design in the units of space
+        space             -       input space, list of (lb, ub) per dimension
+        n_new             -       number of points to add
+        n_candidates      -       size of the Sobol candidate pool, 100 per new point by default
+        returns the n_new points, picked greedily to maximise their distance to the design so far
+        '''
+        bounds = np.asarray(space, dtype=np.float64)
+        lb, width = bounds[:, 0], bounds[:, 1] - bounds[:, 0]
+        design = (np.asarray(x, dtype=np.float64) - lb) / width
+        n_candidates = max(100 * n_new, 1000) if n_candidates is None else n_candidates
+        candidates = sample([(0.0, 1.0)] * bounds.shape[0], n_candidates, method='sobol', seed=seed)
+        # squared distance of every candidate to its nearest design point
+        nearest = np.full(n_candidates, np.inf)
+        for start in range(0, design.shape[0], 1024):
+            nearest = np.minimum(nearest, _sq_dist(candidates, design[start:start + 1024]).min(axis=1))
+        chosen = np.empty(n_new, dtype=np.int64)
+        for i in range(n_new):
+            chosen[i] = np.argmax(nearest)
+            nearest = np.minimum(nearest, np.square(candidates - candidates[chosen[i]]).sum(axis=1))
+        return lb + candidates[chosen] * width
+
+    def _cache_path(self, n_samples, n_dims, seed):
+        if self.cache_dir is None or not isinstance(seed, (int, np.integer)):
+            return None
+        name = '{}_{}_{}_{}_{}x{}.npy'.format(
+            self.criterion, n_samples, n_dims, seed, self.iterations, self.n_chains)
+        return os.path.join(self.cache_dir, name)
+
+
+def _maximin_chain(n_samples, n_dims, iterations, seed):
+    # a swap of rows a, b in column j only changes distances in rows a and b, so each proposal is O(n d)
+    rng = np.random.default_rng(seed)
+    x = np.empty((n_samples, n_dims))
+    for j in range(n_dims):
+        x[:, j] = (rng.permutation(n_samples) + rng.random(n_samples)) / n_samples
+    if n_samples < 3:
+        return x, _min_dist(x)
+    d = _sq_dist(x, x)
+    np.fill_diagonal(d, np.inf)
+    # nearest-neighbour distance per row, only used to steer proposals to the critical points
+    nearest = d.min(axis=1)
+    for it in range(iterations):
+        a = np.argmin(nearest) if rng.random() < 0.5 else rng.integers(n_samples)
+        b = rng.integers(n_samples - 1)
+        b += b >= a
+        j = rng.integers(n_dims)
+        col = x[:, j]
+        shift = np.square(col - col[b]) - np.square(col - col[a])
+        da, db = d[a] + shift, d[b] - shift
+        da[[a, b]], db[[a, b]] = np.inf, np.inf
+        # accept if the closest pair involving a or b moves apart, so the design minimum never drops
+        if min(da.min(), db.min()) < min(d[a].min(), d[b].min()):
+            continue
+        col[a], col[b] = col[b], col[a]
+        da[b], db[a] = d[a, b], d[a, b]
+        d[a], d[:, a], d[b], d[:, b] = da, da, db, db
+        nearest = np.minimum(nearest, np.minimum(da, db))
+        nearest[a], nearest[b] = da.min(), db.min()
+        if it % n_samples == 0:
+            nearest = d.min(axis=1)
+    return x, np.sqrt(d.min())
+
+
+def _min_dist(x):
+    if x.shape[0] < 2:
+        return np.inf
+    d = _sq_dist(x, x)
+    np.fill_diagonal(d, np.inf)
+    return np.sqrt(d.min())
+
+
+def _sq_dist(x1, x2):
+    # |a|^2 + |b|^2 - 2ab through a single matrix product
+    d = np.square(x1).sum(axis=1)[:, None] + np.square(x2).sum(axis=1)[None, :] - 2 * x1 @ x2.T
+    return np.maximum(d, 0.0, out=d)
+
+
+_FEISTEL_ROUNDS = 4
+
+
+def _permute(index, n, keys):
+    # image of index under a pseudo-random permutation of range(n): a keyed Feistel network permutes the
+    # smallest power-of-4 domain holding n, and values that land outside range(n) are mapped again until inside
+    half = max(1, (int(n - 1).bit_length() + 1) // 2)
+    mask = np.uint64((1 << half) - 1)
+    out = _feistel(index, half, mask, keys)
+    outside = out >= n
+    while outside.any():
+        out[outside] = _feistel(out[outside], half, mask, keys)
+        outside = out >= n
+    return out.astype(np.int64)
+
+
+def _feistel(x, half, mask, keys):
+    shift = np.uint64(half)
+    left, right = x >> shift, x & mask
+    for key in keys:
+        # splitmix64 finaliser of the keyed right half as round function, uint64 products wrap
+        h = (right ^ key) * np.uint64(0x9E3779B97F4A7C15)
+        h ^= h >> np.uint64(31)
+        h *= np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(29)
+        left, right = right, left ^ (h & mask)
+    return (left << shift) | right
+
+
+def _iter_grid(bounds, n_samples, chunk_size, rng, shuffle, levels):
+    # grid points are addressed by flat index and decoded per chunk, the product is never built
+    m = bounds.shape[0]
+    if levels is not None:
+        n = levels
+    elif n_samples is not None:
+        n = grid_size(n_samples, m)
+    else:
+        raise ValueError('grid sampling needs n_samples or levels')
+    total = n ** m
+    if n_samples is None:
+        n_samples, shuffle = total, False
+    elif n_samples > total:
+        raise ValueError('{} samples do not fit on a grid of {} points'.format(n_samples, total))
+    levels = [np.linspace(lb, ub, n) for lb, ub in bounds]
+    if shuffle:
+        index = rng.choice(total, size=n_samples, replace=False)
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        flat = index[start:stop] if shuffle else np.arange(start, stop, dtype=np.int64)
+        position = np.unravel_index(flat, (n,) * m)
+        yield np.stack([levels[j][position[j]] for j in range(m)], axis=1)
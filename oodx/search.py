@@ -0,0 +1,204 @@
+import numpy as np
+import torch
+import gpytorch as gpy
+import pyomo.environ as pyo
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .nn import NN
+from .Hybrid import HybridModel
+from .formulations import OODXBlock, formulation_size
+
+
+class NNSearch:
+    '''
+    successive halving search over the layouts, activations, learning rates and weight decays of NN or HybridModel
+    surrogates, trials are ranked on a held-out split and can be penalised by the size of their formulation
+    layouts               -       hidden layer sizes to try, e.g. [(10,), (20, 20)], for a hybrid model the last one
+                                  is the feature dimension
+    activations           -       activation names
+    learning_rates        -       Adam learning rates
+    weight_decays         -       Adam weight decays
+    model                 -       'NN' or 'Hybrid'
+    kernel                -       kernel of the hybrid model
+    is_classifier         -       search NN classifiers, ranked by the validation cross-entropy
+    n_trials              -       configurations drawn from the grid, every one when None
+    min_epochs            -       epochs of every trial in the first rung
+    max_epochs            -       epochs the trials of the last rung reach
+    eta                   -       each rung keeps the best 1 / eta of its trials and trains them eta times longer
+    val_split             -       fraction of the samples held out to rank the trials
+    batch_size            -       mini-batch size
+    size_weight           -       weight of log(formulation terms) added to log(validation loss) in the score
+    space                 -       input space [[lb, ub], ...] of the formulations, the bounding box of x when None
+    n_jobs                -       worker processes, -1 uses every core
+    torch_threads         -       torch threads per worker so that the workers do not oversubscribe the cores
+    seed                  -       seed of the trial draw, the split and the initial weights
+    '''
+    def __init__(self, layouts=((10,), (20,), (10, 10), (20, 20)),
+                 activations=('tanh', 'relu', 'softplus', 'sigmoid', 'hardsigmoid', 'leaky relu'),
+                 learning_rates=(1e-3, 1e-2), weight_decays=(0.0, 1e-4), model='NN', kernel='rbf', is_classifier=False,
+                 n_trials=None, min_epochs=50, max_epochs=800, eta=3, val_split=0.2, batch_size=10, size_weight=0.0,
+                 space=None, n_jobs=1, torch_threads=1, seed=None):
+        if model not in ('NN', 'Hybrid'):
+            raise ValueError('unknown model {}'.format(model))
+        self.layouts = layouts
+        self.activations = activations
+        self.learning_rates = learning_rates
+        self.weight_decays = weight_decays
+        self.model = model
+        self.kernel = kernel
+        self.is_classifier = is_classifier
+        self.n_trials = n_trials
+        self.min_epochs = min_epochs
+        self.max_epochs = max_epochs
+        self.eta = eta
+        self.val_split = val_split
+        self.batch_size = batch_size
+        self.size_weight = size_weight
+        self.space = space
+        self.n_jobs = n_jobs
+        self.torch_threads = torch_threads
+        self.seed = seed
+        self.leaderboard = None
+        self.best_model = None
+        self.time = None
+
+    def fit(self, x, y):
+        '''
+        runs the search, returns the leaderboard, the trials of the last rung first and each rung sorted by score
+        '''
+        start_time = time.time()
+        x = np.asarray(x, dtype=np.float32)
+        y = np.asarray(y, dtype=np.float32).ravel()
+        rng = np.random.default_rng(self.seed)
+
+        # one split for every trial so their validation losses compare
+        permutation = rng.permutation(len(x))
+        n_val = max(1, int(round(self.val_split * len(x))))
+        data = (x[permutation[n_val:]], y[permutation[n_val:]], x[permutation[:n_val]], y[permutation[:n_val]])
+        space = self.space if self.space is not None else np.c_[x.min(axis=0), x.max(axis=0)].tolist()
+
+        configs = list(itertools.product(self.layouts, self.activations, self.learning_rates, self.weight_decays))
+        if self.n_trials is not None and self.n_trials < len(configs):
+            configs = [configs[i] for i in rng.choice(len(configs), self.n_trials, replace=False)]
+        seed = int(rng.integers(2 ** 31)) if self.seed is None else self.seed
+        trials = [{
+            'id': i, 'layers': self._layers(x.shape[1], layout), 'activation': activation,
+            'learning_rate': learning_rate, 'weight_decay': weight_decay, 'seed': seed + i, 'epochs': 0,
+            'val_loss': np.inf, 'time': 0.0, 'state': None
+        } for i, (layout, activation, learning_rate, weight_decay) in enumerate(configs)]
+
+        settings = {'model': self.model, 'kernel': self.kernel, 'is_classifier': self.is_classifier,
+                    'batch_size': self.batch_size, 'space': space}
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        if n_jobs == 1:
+            _init_search_worker(data, settings, None)
+            self._halving(trials, lambda tasks: [_search_worker(task) for task in tasks])
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_search_worker,
+                                     initargs=(data, settings, self.torch_threads)) as pool:
+                self._halving(trials, lambda tasks: list(pool.map(_search_worker, tasks)))
+
+        for trial in trials:
+            trial['score'] = np.log(max(trial['val_loss'], 1e-300))
+            if self.size_weight and trial['terms']:
+                trial['score'] += self.size_weight * np.log(trial['terms'])
+        trials.sort(key=lambda trial: (-trial['epochs'], trial['score']))
+        self.best_model = _build(trials[0], data, settings)
+        self.leaderboard = [{key: value for key, value in trial.items() if key != 'state'} for trial in trials]
+        self.time = time.time() - start_time
+        return self.leaderboard
+
+    def _halving(self, trials, run):
+        # trains the surviving trials up to the rung budget, then keeps the best 1 / eta of them, a lone survivor goes
+        # straight to max_epochs
+        alive = trials
+        budget = min(self.min_epochs, self.max_epochs)
+        while True:
+            results = run([(trial, budget - trial['epochs']) for trial in alive])
+            for trial, result in zip(alive, results):
+                trial.update(result)
+                trial['epochs'] = budget
+            if budget >= self.max_epochs:
+                break
+            alive = sorted(alive, key=lambda trial: trial['val_loss'])[:max(1, len(alive) // self.eta)]
+            budget = self.max_epochs if len(alive) == 1 else min(budget * self.eta, self.max_epochs)
+
+    def _layers(self, n_inputs, layout):
+        if self.model == 'Hybrid':
+            return [n_inputs] + list(layout)
+        return [n_inputs] + list(layout) + [1]
+
+
+_search_data = None
+_search_settings = None
+
+
+def _init_search_worker(data, settings, torch_threads):
+    # data and settings are shipped once per worker process rather than with every trial
+    global _search_data, _search_settings
+    _search_data, _search_settings = data, settings
+    if torch_threads is not None:
+        torch.set_num_threads(torch_threads)
+
+
+def _build(trial, data, settings):
+    # model of a trial, from its saved weights when it has been trained
+    x_train, y_train = data[:2]
+    torch.manual_seed(trial['seed'])
+    if settings['model'] == 'Hybrid':
+        model = HybridModel(x_train, y_train, gpy.likelihoods.GaussianLikelihood(), trial['layers'],
+                            trial['activation'], settings['kernel'])
+    else:
+        model = NN(trial['layers'], trial['activation'], is_classifier=settings['is_classifier'])
+    if trial['state'] is not None:
+        model.load_state_dict({key: torch.from_numpy(value) for key, value in trial['state'].items()})
+        if settings['model'] == 'Hybrid':
+            model.save_params()
+        else:
+            model._get_params()
+    return model
+
+
+def _search_worker(task):
+    # continues a trial for the given epochs, returns its weights, validation loss and formulation size
+    trial, epochs = task
+    x_train, y_train, x_val, y_val = _search_data
+    settings = _search_settings
+    start_time = time.time()
+    model = _build(trial, _search_data, settings)
+    if settings['model'] == 'Hybrid':
+        model.fit(batch_size=settings['batch_size'], epochs=epochs, learning_rate=trial['learning_rate'],
+                  weight_decay=trial['weight_decay'])
+        prediction = model.predict(x_val)
+    else:
+        model.fit(x_train, y_train, batch_size=settings['batch_size'], epochs=epochs,
+                  learning_rate=trial['learning_rate'], weight_decay=trial['weight_decay'], seed=trial['seed'])
+        prediction = model.predict(x_val)
+    prediction = np.ravel(prediction)
+    if settings['is_classifier']:
+        p = np.clip(prediction, 1e-7, 1 - 1e-7)
+        val_loss = float(-np.mean(y_val * np.log(p) + (1 - y_val) * np.log(1 - p)))
+    else:
+        val_loss = float(np.mean((prediction - y_val) ** 2))
+    if not np.isfinite(val_loss):
+        val_loss = np.inf
+
+    result = {'state': {key: value.detach().cpu().numpy() for key, value in model.state_dict().items()},
+              'val_loss': val_loss, 'time': trial['time'] + time.time() - start_time}
+    result.update(_size(model, settings))
+    return result
+
+
+def _size(model, settings):
+    # formulation size over the search space, None where the model has no formulation
+    size = {'variables': None, 'binaries': None, 'constraints': None, 'terms': None}
+    if settings['model'] == 'Hybrid' and settings['kernel'] != 'rbf':
+        return size
+    block = pyo.ConcreteModel()
+    block.b = OODXBlock(model).get_formulation(space=settings['space'])
+    if block.b is not None:
+        size.update(formulation_size(block.b))
+    return size
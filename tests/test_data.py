@@ -0,0 +1,24 @@
+import os
+
+import numpy as np
+
+from oodx import DataHandler
+
+
+DATA = os.path.join(os.path.dirname(__file__), '..', 'Data')
+
+
+def test_single_output_scaling_with_multi_column_y():
+    # the GUI fits on the first output column of a two-column y file
+    data = DataHandler()
+    data.x = np.loadtxt(os.path.join(DATA, 'x14_A2O.txt'))
+    data.y = np.loadtxt(os.path.join(DATA, 'gas_A2O.txt'))
+    data.t = np.ones((data.y.shape[0], 1))
+    data.split()
+    data.scale()
+    y = data.y_train_[:3, 0]
+    expected = y * data.y_train_std[0] + data.y_train_mean[0]
+    for pred in (y, y.reshape(-1, 1)):
+        np.testing.assert_allclose(data.inv_scale_y(pred).ravel(), expected)
+        np.testing.assert_allclose(data.scale_y(data.inv_scale_y(pred)).ravel(), y)
+    assert data.inv_scale_y(data.y_train_[:3]).shape == (3, 2)